@@ -1,58 +1,250 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file
+from flask import Flask, Response, render_template, request, redirect, url_for, send_file, jsonify, stream_with_context
 from pathlib import Path
-
-# IMPORT YOUR PIPELINE FUNCTIONS
-from gist_to_story import generate_story_with_moral
-from split_pages import split_pages
+import json
+import os
+import threading
+import time
+
+from jobs import JobQueue, QueueFullError
+from page_editor import EditError, edit_page
+from pdf_generator import PDF_PROFILES, DEFAULT_PDF_PROFILE
+import archive
+import gist_index
+import metrics
+import workspace
 
 app = Flask(__name__)
 
 BASE_DIR = Path(__file__).resolve().parent
 PDF_PATH = BASE_DIR / "static" / "pdf" / "storybook.pdf"
 
+# Background workers running the story -> images -> PDF pipeline
+job_queue = JobQueue()
+
+# Seconds between status checks while streaming a job's events
+EVENTS_POLL_INTERVAL = 0.5
+# Comment line sent this often so proxies keep idle event streams open
+EVENTS_KEEPALIVE = 15
+# Each open event stream holds a request thread. Streams end after EVENTS_MAX_SECONDS (the browser
+# reconnects on its own) and past EVENTS_MAX_STREAMS at once the page falls back to polling /status.
+EVENTS_MAX_SECONDS = int(os.getenv("EVENTS_MAX_SECONDS", "30"))
+EVENTS_MAX_STREAMS = int(os.getenv("EVENTS_MAX_STREAMS", "8"))
+_event_streams = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+PREVIEW_MIMETYPES = {".webp": "image/webp", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png"}
+
+
+def wants_json():
+    return request.accept_mimetypes.best == "application/json"
+
+def sse(event, data):
+    """One Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def page_sort_key(key):
+    return int(key.split("_")[1])
 
 @app.route("/", methods=["GET"])
 def index():
-    return render_template("index.html")
+    return render_template("index.html", profiles=PDF_PROFILES, default_profile=DEFAULT_PDF_PROFILE)
 
 @app.route("/generate", methods=["POST"])
 def generate():
     gist = request.form.get("gist", "").strip()
+    # Skip the story cache and ask for a new variation
+    fresh = request.form.get("fresh") in ("1", "true", "on")
+    # PDF output profile: web, print or thumbnail
+    profile = request.form.get("profile") or DEFAULT_PDF_PROFILE
 
     if not gist:
         return "Story idea is required", 400
+    if profile not in PDF_PROFILES:
+        return f"Unknown PDF profile: {profile}", 400
+
+    # A near-identical idea may already have a finished book; "fresh" asks for a new one anyway.
+    # JSON clients always get a job unless they ask for matches, so the API keeps answering 202.
+    similar = request.form.get("similar", "off") if wants_json() else gist_index.SIMILAR_GISTS
+    if not fresh and similar in ("offer", "serve"):
+        try:
+            matches = archive.find_similar(gist)
+        except Exception as e:
+            print(f"Warning: Similar gist lookup failed: {e}")
+            matches = []
+        if matches:
+            match = matches[0]
+            book_url = url_for("archived_book", story_id=match["story_id"])
+            # Only a gist with exactly the same words is served without asking
+            if similar == "serve" and gist_index.same_words(gist, match["gist"] or match["title"] or ""):
+                if wants_json():
+                    return jsonify({"match": match, "download_url": book_url})
+                return redirect(book_url)
+            if wants_json():
+                return jsonify({"match": match, "download_url": book_url,
+                                "hint": "Send fresh=1 to generate a new storybook anyway"})
+            return render_template("index.html", profiles=PDF_PROFILES, default_profile=DEFAULT_PDF_PROFILE,
+                                   match=match, book_url=book_url, gist=gist, profile=profile)
 
     try:
-        # Generate story
-        story_data = generate_story_with_moral(gist)
-
-        #  Split into pages
-        split_pages(story_data)
-
-        # Generate images
-        import image_generator
-        image_generator.main()
-
-        # Generate PDF
-        import pdf_generator
-        pdf_generator.main()
-
-    except Exception as e:
-        return f"Error while generating storybook: {e}", 500
+        job_id = job_queue.submit(gist, fresh=fresh, profile=profile)
+    except QueueFullError as e:
+        message = "Too many storybooks in progress, try again later"
+        body = jsonify({"error": message}) if wants_json() else message
+        return body, 429, {"Retry-After": str(e.retry_after)}
+
+    if wants_json():
+        return jsonify({
+            "job_id": job_id,
+            "status_url": url_for("status", job_id=job_id),
+            "download_url": url_for("download", job_id=job_id),
+        }), 202
+
+    return redirect(url_for("job_page", job_id=job_id))
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_page(job_id):
+    if job_queue.get_status(job_id) is None:
+        return "Unknown job ID", 404
+    return render_template("index.html", job_id=job_id)
+
+@app.route("/jobs/<job_id>/pages/<int:page_number>", methods=["POST"])
+def edit_job_page(job_id, page_number):
+    # Fields to change on the page: title, story_overview, text, scene or moral
+    changes = request.get_json(silent=True) if request.is_json else request.form.to_dict()
+    if not isinstance(changes, dict) or not changes:
+        return jsonify({"error": "Nothing to change"}), 400
+    if job_queue.get_status(job_id) is None:
+        return jsonify({"error": "Unknown job ID"}), 404
 
-    return redirect(url_for("download"))
+    try:
+        result = edit_page(job_id, page_number, changes)
+    except EditError as e:
+        return jsonify({"error": str(e)}), 400
+
+    result["download_url"] = url_for("download", job_id=job_id)
+    return jsonify(result)
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """Server-Sent Events: stage changes, each finished page with its preview, then done/failed
+
+    A reconnecting browser gets the finished pages again; the page skips ones it already shows.
+    """
+    if job_queue.get_status(job_id) is None:
+        return "Unknown job ID", 404
+    if not _event_streams.acquire(blocking=False):
+        return "Too many event streams, poll the status instead", 503
+
+    def stream():
+        try:
+            yield from job_stream(job_id)
+        finally:
+            _event_streams.release()
+
+    return Response(stream_with_context(stream()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def job_stream(job_id):
+    """SSE messages for one job until it finishes or EVENTS_MAX_SECONDS have passed"""
+    sent_pages = set()
+    last_progress = None
+    started = last_sent = time.time()
+    while True:
+        job = job_queue.get_status(job_id)
+        if job is None:
+            return
+        messages = []
+
+        progress = (job["stage"], job["pages_done"], job["pages_total"])
+        if progress != last_progress:
+            last_progress = progress
+            messages.append(sse("stage", {"stage": job["stage"], "pages_done": job["pages_done"],
+                                          "pages_total": job["pages_total"]}))
+
+        for key in sorted(set(job["pages"]) - sent_pages, key=page_sort_key):
+            sent_pages.add(key)
+            state = job["pages"][key]
+            number = page_sort_key(key)
+            preview_url = url_for("page_preview", job_id=job_id, page_number=number) if state == "done" else None
+            messages.append(sse("page", {"key": key, "page": number, "state": state, "preview_url": preview_url}))
+
+        if job["state"] == "done":
+            messages.append(sse("done", {"download_url": url_for("download", job_id=job_id),
+                                         "pages_failed": job.get("pages_failed") or []}))
+        elif job["state"] == "failed":
+            messages.append(sse("failed", {"error": job.get("error")}))
+
+        if messages:
+            yield "".join(messages)
+            last_sent = time.time()
+        elif time.time() - last_sent > EVENTS_KEEPALIVE:
+            yield ": keep-alive\n\n"
+            last_sent = time.time()
+
+        if job["state"] in ("done", "failed"):
+            return
+        if time.time() - started > EVENTS_MAX_SECONDS:
+            # Frees this thread; the browser reconnects after the retry delay
+            yield "retry: 1000\n\n"
+            return
+        time.sleep(EVENTS_POLL_INTERVAL)
+
+@app.route("/jobs/<job_id>/pages/<int:page_number>/preview", methods=["GET"])
+def page_preview(job_id, page_number):
+    if not workspace.is_valid_job_id(job_id):
+        return "Unknown job ID", 404
+    previews = sorted(workspace.get_previews_dir(job_id).glob(f"page_{page_number}.*"))
+    if not previews:
+        return "Preview not found", 404
+    preview = previews[0]
+    return send_file(preview, mimetype=PREVIEW_MIMETYPES.get(preview.suffix.lower(), "application/octet-stream"),
+                     max_age=0)
+
+@app.route("/status/<job_id>", methods=["GET"])
+def status(job_id):
+    job_status = job_queue.get_status(job_id)
+    if job_status is None:
+        return jsonify({"error": "Unknown job ID"}), 404
+    return jsonify(job_status)
 
 @app.route("/download", methods=["GET"])
-def download():
-    if not PDF_PATH.exists():
+@app.route("/download/<job_id>", methods=["GET"])
+def download(job_id=None):
+    if job_id is None:
+        pdf_path = PDF_PATH
+    elif workspace.is_valid_job_id(job_id):
+        pdf_path = workspace.get_pdf_path(job_id)
+    else:
+        return "Unknown job ID", 404
+
+    if not pdf_path.exists():
+        # Old job folders are swept once the book is archived
+        book = archive.get_book(job_id) if job_id else None
+        if book and book["pdf_path"] is not None:
+            return redirect(url_for("archived_book", story_id=job_id))
         return "PDF not found. Generate the story first.", 404
 
     return send_file(
-        PDF_PATH,
+        pdf_path,
         as_attachment=True,
         download_name="storybook.pdf"
     )
 
+@app.route("/books/<story_id>", methods=["GET"])
+def archived_book(story_id):
+    book = archive.get_book(story_id) if workspace.is_valid_job_id(story_id) else None
+    if book is None or book["pdf_path"] is None or not book["pdf_path"].exists():
+        return "Storybook not found", 404
+
+    return send_file(
+        book["pdf_path"],
+        mimetype="application/pdf",
+        as_attachment=True,
+        download_name="storybook.pdf"
+    )
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    # Prometheus text format, covering the jobs run by this process
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
 if __name__ == "__main__":
     app.run(debug=True)
-
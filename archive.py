@@ -0,0 +1,386 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+
+import fileutil
+import gist_index
+import metrics
+import workspace
+
+BASE_DIR = Path(__file__).resolve().parent
+ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", BASE_DIR / "output" / "archive"))
+ARCHIVE_ENABLED = os.getenv("ARCHIVE", "1") != "0"
+# Oldest books are dropped once blobs take more than this, or once they are older than ARCHIVE_MAX_AGE
+ARCHIVE_MAX_BYTES = int(os.getenv("ARCHIVE_MAX_MB", "2048")) * 1024 * 1024
+ARCHIVE_MAX_AGE = int(os.getenv("ARCHIVE_MAX_AGE_DAYS", "90")) * 24 * 3600
+# Job workspaces (the live copy of a book, used for page edits) are removed once finished and idle
+# for JOB_MAX_AGE, and oldest first while all of them take more than JOBS_MAX_BYTES.
+# Their books stay downloadable from the archive.
+JOB_MAX_AGE = int(os.getenv("JOB_MAX_AGE_HOURS", "72")) * 3600
+JOBS_MAX_BYTES = int(os.getenv("JOBS_MAX_MB", "4096")) * 1024 * 1024
+# Seconds between two sweeps of the job folders by one process
+JOB_SWEEP_INTERVAL = 600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS books (
+    story_id TEXT PRIMARY KEY,
+    title TEXT,
+    gist TEXT,
+    character TEXT,
+    story_hash TEXT,
+    pdf_hash TEXT,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    story_id TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    image_hash TEXT NOT NULL,
+    media_type TEXT,
+    PRIMARY KEY (story_id, page)
+);
+CREATE TABLE IF NOT EXISTS gist_bands (
+    story_id TEXT NOT NULL,
+    band INTEGER NOT NULL,
+    bucket TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS books_created ON books (created);
+CREATE INDEX IF NOT EXISTS pages_image ON pages (image_hash);
+CREATE INDEX IF NOT EXISTS gist_bands_bucket ON gist_bands (band, bucket);
+CREATE INDEX IF NOT EXISTS gist_bands_story ON gist_bands (story_id);
+"""
+
+# Blobs that no book refers to any more
+UNREFERENCED_BLOBS = """
+SELECT hash, size FROM blobs WHERE hash NOT IN (
+    SELECT story_hash FROM books WHERE story_hash IS NOT NULL
+    UNION SELECT pdf_hash FROM books WHERE pdf_hash IS NOT NULL
+    UNION SELECT image_hash FROM pages
+)
+"""
+
+def get_db_path():
+    return ARCHIVE_DIR / "index.sqlite3"
+
+def get_blob_path(blob_hash):
+    """Stored file of a blob (two-level fan-out keeps folders small)"""
+    return ARCHIVE_DIR / "blobs" / blob_hash[:2] / blob_hash
+
+def connect():
+    """Connection to the index; writers take the lock with BEGIN IMMEDIATE"""
+    ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(get_db_path()), timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    if conn.execute("PRAGMA user_version").fetchone()[0] < gist_index.INDEX_VERSION:
+        _reindex_gists(conn)
+    return conn
+
+def _put_blob(conn, data, now):
+    """Store bytes once by content hash (inside a write transaction). Returns the hash."""
+    blob_hash = hashlib.sha256(data).hexdigest()
+    path = get_blob_path(blob_hash)
+    # Rewritten if the file went missing, the row alone proves nothing
+    if not path.exists():
+        fileutil.atomic_write_bytes(path, data)
+    conn.execute("INSERT OR IGNORE INTO blobs (hash, size, created) VALUES (?, ?, ?)", (blob_hash, len(data), now))
+    return blob_hash
+
+def add_book(story_id, story=None, gist=None, pdf_data=None, pages=None, enforce=True):
+    """Index a book, storing its story, PDF and page images as deduplicated blobs
+
+    story is the page dict of story.json; pages maps page number to (bytes, media type).
+    Adding an existing story_id replaces its record (the gist is kept if not given).
+    """
+    if not ARCHIVE_ENABLED:
+        return None
+    story = story or {}
+    title_page = story.get("page_1", {})
+    now = time.time()
+
+    with closing(connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            story_hash = None
+            if story:
+                story_hash = _put_blob(conn, json.dumps(story, ensure_ascii=False, sort_keys=True).encode("utf-8"), now)
+            pdf_hash = _put_blob(conn, pdf_data, now) if pdf_data else None
+            page_rows = [(story_id, number, _put_blob(conn, data, now), media_type)
+                         for number, (data, media_type) in sorted((pages or {}).items())]
+
+            conn.execute(
+                "INSERT INTO books (story_id, title, gist, character, story_hash, pdf_hash, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (story_id) DO UPDATE SET title = excluded.title, "
+                "gist = COALESCE(excluded.gist, books.gist), character = excluded.character, "
+                "story_hash = excluded.story_hash, pdf_hash = excluded.pdf_hash, created = excluded.created",
+                (story_id, title_page.get("title"), gist, json.dumps(title_page.get("character") or {}, ensure_ascii=False),
+                 story_hash, pdf_hash, now),
+            )
+            conn.execute("DELETE FROM pages WHERE story_id = ?", (story_id,))
+            conn.executemany("INSERT INTO pages (story_id, page, image_hash, media_type) VALUES (?, ?, ?, ?)", page_rows)
+            _index_gist(conn, story_id)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    if enforce:
+        enforce_retention()
+        sweep_jobs()
+    return story_id
+
+@metrics.timed("archive")
+def archive_files(story_path=None, images_dir=None, pdf_path=None, gist=None, story_id=None):
+    """Archive the shared story/images folders as one book, then clear them
+
+    The story files and page images are moved into the archive (removed from their
+    folders); the PDF is copied. Returns the story ID, or None if nothing was archived.
+    """
+    from split_pages import load_story
+
+    story = load_story(story_path) if story_path and Path(story_path).exists() else None
+    image_files = []
+    if images_dir and Path(images_dir).exists():
+        image_files = [p for p in Path(images_dir).glob("page_*.png") if p.is_file()]
+    pages = {}
+    for path in image_files:
+        try:
+            pages[int(path.stem.split("_")[1])] = (path.read_bytes(), "image/png")
+        except (ValueError, IndexError):
+            continue
+    pdf_data = Path(pdf_path).read_bytes() if pdf_path and Path(pdf_path).exists() else None
+    if not story and not pages and not pdf_data:
+        return None
+
+    story_id = add_book(story_id or workspace.new_job_id(), story, gist, pdf_data, pages)
+    if story_id is None:
+        # Archiving is off: leave the files where they are
+        return None
+    print(f"Archived story {story_id} to {ARCHIVE_DIR}")
+
+    leftovers = list(image_files)
+    if story_path:
+        story_folder = Path(story_path).parent
+        for pattern in ("story.json", "metadata.json", "story_structured.json", "page_*.json"):
+            leftovers.extend(p for p in story_folder.glob(pattern) if p.is_file())
+    for path in leftovers:
+        try:
+            path.unlink()
+        except OSError as e:
+            print(f"Warning: Failed to remove {path}: {e}")
+    return story_id
+
+@metrics.timed("archive")
+def archive_job(job_id, gist=None):
+    """Index a finished job's storybook: story, PDF and encoded pages. Never raises."""
+    if not ARCHIVE_ENABLED:
+        return None
+    from split_pages import load_story
+
+    try:
+        story_path = workspace.get_stories_dir(job_id) / "story.json"
+        pdf_path = workspace.get_pdf_path(job_id)
+        pages = {}
+        for meta_path in workspace.get_pdf_pages_dir(job_id).glob("page_*.json"):
+            data_path = meta_path.with_suffix(".bin")
+            if data_path.exists():
+                pages[int(meta_path.stem.split("_")[1])] = (data_path.read_bytes(), "image/jpeg")
+        return add_book(job_id, load_story(story_path) if story_path.exists() else None, gist,
+                        pdf_path.read_bytes() if pdf_path.exists() else None, pages)
+    except Exception as e:
+        print(f"Warning: Failed to archive job {job_id}: {e}")
+        return None
+
+def get_book(story_id):
+    """Index record of a book with its pages and blob paths, or None"""
+    if not get_db_path().exists():
+        return None
+    with closing(connect()) as conn:
+        row = conn.execute("SELECT * FROM books WHERE story_id = ?", (story_id,)).fetchone()
+        if row is None:
+            return None
+        pages = conn.execute("SELECT page, image_hash, media_type FROM pages WHERE story_id = ? ORDER BY page",
+                             (story_id,)).fetchall()
+    book = dict(row)
+    book["character"] = json.loads(book["character"] or "{}")
+    book["pdf_path"] = get_blob_path(book["pdf_hash"]) if book["pdf_hash"] else None
+    book["pages"] = [dict(p, path=get_blob_path(p["image_hash"])) for p in pages]
+    return book
+
+def _collect_garbage(conn):
+    """Delete unreferenced blobs (inside a write transaction). Returns bytes freed."""
+    freed = 0
+    for row in conn.execute(UNREFERENCED_BLOBS).fetchall():
+        conn.execute("DELETE FROM blobs WHERE hash = ?", (row["hash"],))
+        try:
+            get_blob_path(row["hash"]).unlink()
+        except FileNotFoundError:
+            pass
+        freed += row["size"]
+    return freed
+
+def enforce_retention(max_bytes=None, max_age=None):
+    """Drop books past max_age, then the oldest ones until blobs fit in max_bytes. Returns books removed."""
+    if max_bytes is None:
+        max_bytes = ARCHIVE_MAX_BYTES
+    if max_age is None:
+        max_age = ARCHIVE_MAX_AGE
+    if not get_db_path().exists():
+        return 0
+
+    removed = 0
+    with closing(connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cutoff = time.time() - max_age
+            expired = [r["story_id"] for r in conn.execute("SELECT story_id FROM books WHERE created < ?", (cutoff,))]
+            for story_id in expired:
+                _delete_book(conn, story_id)
+            removed += len(expired)
+            _collect_garbage(conn)
+
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            while total > max_bytes:
+                oldest = conn.execute("SELECT story_id FROM books ORDER BY created LIMIT 1").fetchone()
+                if oldest is None:
+                    break
+                _delete_book(conn, oldest["story_id"])
+                removed += 1
+                total -= _collect_garbage(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    return removed
+
+_last_sweep = 0.0
+
+def _folder_size(folder):
+    size = 0
+    for path in folder.rglob("*"):
+        try:
+            if path.is_file():
+                size += path.stat().st_size
+        except OSError:
+            pass
+    return size
+
+def sweep_jobs(max_bytes=None, max_age=None, force=False):
+    """Remove finished job workspaces past max_age, then the oldest until all fit in max_bytes
+
+    Jobs still queued or running are left alone unless they have not moved for max_age.
+    Runs at most every JOB_SWEEP_INTERVAL seconds unless forced. Returns the number removed.
+    """
+    global _last_sweep
+    if max_bytes is None:
+        max_bytes = JOBS_MAX_BYTES
+    if max_age is None:
+        max_age = JOB_MAX_AGE
+    now = time.time()
+    if not force and now - _last_sweep < JOB_SWEEP_INTERVAL:
+        return 0
+    _last_sweep = now
+    if not workspace.JOBS_DIR.exists():
+        return 0
+
+    jobs = []
+    for folder in workspace.JOBS_DIR.iterdir():
+        if not folder.is_dir() or not workspace.is_valid_job_id(folder.name):
+            continue
+        status = fileutil.read_json(folder / "status.json") or {}
+        # Page edits rewrite the PDF, so it counts as activity too
+        pdf_path = workspace.get_pdf_path(folder.name)
+        mtimes = [status.get("updated") or 0.0]
+        for path in (folder, pdf_path):
+            try:
+                mtimes.append(path.stat().st_mtime)
+            except OSError:
+                pass
+        last_active = max(mtimes)
+        finished = status.get("state") in ("done", "failed")
+        if not finished and now - last_active < max_age:
+            continue
+        jobs.append((last_active, folder.name, folder))
+
+    removed = 0
+    jobs.sort()
+    kept = []
+    for last_active, job_id, folder in jobs:
+        if now - last_active >= max_age:
+            workspace.remove_workspace(job_id)
+            removed += 1
+        else:
+            kept.append((job_id, folder))
+
+    if kept:
+        total = _folder_size(workspace.JOBS_DIR)
+        for job_id, folder in kept:
+            if total <= max_bytes:
+                break
+            total -= _folder_size(folder)
+            workspace.remove_workspace(job_id)
+            removed += 1
+    return removed
+
+def _index_gist(conn, story_id):
+    """(Re)build the near-duplicate lookup rows of a book from its gist and title"""
+    conn.execute("DELETE FROM gist_bands WHERE story_id = ?", (story_id,))
+    row = conn.execute("SELECT gist, title FROM books WHERE story_id = ?", (story_id,)).fetchone()
+    keys = set()
+    for text in (row["gist"], row["title"]):
+        if text:
+            keys.update(gist_index.band_keys(text))
+    conn.executemany("INSERT INTO gist_bands (story_id, band, bucket) VALUES (?, ?, ?)",
+                     [(story_id, band, bucket) for band, bucket in sorted(keys)])
+
+def _reindex_gists(conn):
+    """Rebuild every book's lookup rows after the gist index changed"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Another process may have done it while we waited for the lock
+        if conn.execute("PRAGMA user_version").fetchone()[0] < gist_index.INDEX_VERSION:
+            for row in conn.execute("SELECT story_id FROM books").fetchall():
+                _index_gist(conn, row["story_id"])
+            conn.execute(f"PRAGMA user_version = {int(gist_index.INDEX_VERSION)}")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def find_similar(gist, threshold=None, limit=5):
+    """Archived books (with a PDF) whose gist or title is at least threshold similar, best first"""
+    if threshold is None:
+        threshold = gist_index.SIMILAR_GIST_THRESHOLD
+    keys = gist_index.band_keys(gist)
+    if not keys or not get_db_path().exists():
+        return []
+    where = " OR ".join("(g.band = ? AND g.bucket = ?)" for _ in keys)
+    params = [value for key in keys for value in key]
+    with closing(connect()) as conn:
+        rows = conn.execute(
+            "SELECT DISTINCT b.story_id, b.title, b.gist, b.created FROM gist_bands g "
+            f"JOIN books b ON b.story_id = g.story_id WHERE b.pdf_hash IS NOT NULL AND ({where})",
+            params,
+        ).fetchall()
+
+    matches = []
+    for row in rows:
+        score = gist_index.similarity(gist, row["gist"], row["title"])
+        if score >= threshold:
+            matches.append(dict(row, score=round(score, 3)))
+    matches.sort(key=lambda m: (-m["score"], -m["created"]))
+    return matches[:limit]
+
+def _delete_book(conn, story_id):
+    conn.execute("DELETE FROM gist_bands WHERE story_id = ?", (story_id,))
+    conn.execute("DELETE FROM pages WHERE story_id = ?", (story_id,))
+    conn.execute("DELETE FROM books WHERE story_id = ?", (story_id,))
@@ -0,0 +1,261 @@
+import argparse
+import csv
+import json
+import re
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import archive
+import fileutil
+import workspace
+from pipeline import ImageError, StoryError, get_pipeline, save_render_settings
+
+# Stories generated at the same time (each one also runs IMAGE_WORKERS page requests)
+BATCH_CONCURRENCY = 2
+
+
+def read_gists(path):
+    """Entries {"id", "gist", ...} from a JSONL file (objects or bare strings) or a CSV with a gist column"""
+    path = Path(path)
+    entries = []
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.suffix.lower() == ".csv":
+            rows = list(csv.DictReader(f))
+        else:
+            rows = []
+            for line_no, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    raise ValueError(f"{path}:{line_no}: not valid JSON ({e})")
+                rows.append(row if isinstance(row, dict) else {"gist": row})
+
+    seen = set()
+    for number, row in enumerate(rows, start=1):
+        gist = str(row.get("gist") or "").strip()
+        if not gist:
+            print(f"Skipping entry {number}: no gist")
+            continue
+        # Story IDs name the checkpoint files, so keep them filesystem safe
+        story_id = re.sub(r"[^A-Za-z0-9_.-]+", "_", str(row.get("id") or f"{number:05d}"))
+        if story_id in seen:
+            raise ValueError(f"Duplicate story id {story_id!r} in {path}")
+        seen.add(story_id)
+        entries.append(dict(row, id=story_id, gist=gist))
+    return entries
+
+
+class BatchRun:
+    """Generates a storybook for every gist of an input file, resumable after a crash
+
+    Each story gets its own job workspace and a checkpoint file under the batch
+    folder. A rerun skips finished books, reuses a saved story.json instead of
+    calling the LLM again, and only renders the pages whose encoded PDF page is
+    not stored yet.
+    """
+
+    def __init__(self, input_path, batch_dir=None, concurrency=BATCH_CONCURRENCY, profile=None, fresh=False,
+                 image_workers=None):
+        self.input_path = Path(input_path)
+        self.batch_dir = Path(batch_dir) if batch_dir else workspace.get_batch_dir(self.input_path.stem)
+        self.concurrency = max(1, concurrency)
+        self.profile = profile
+        self.fresh = fresh
+        self.image_workers = image_workers
+
+    def checkpoint_path(self, story_id):
+        return self.batch_dir / "stories" / f"{story_id}.json"
+
+    def load_checkpoint(self, entry):
+        """Saved progress of a story, or a new checkpoint if there is none for this gist"""
+        checkpoint = fileutil.read_json(self.checkpoint_path(entry["id"]))
+        if checkpoint and checkpoint.get("gist") == entry["gist"] and workspace.is_valid_job_id(checkpoint.get("job_id")):
+            return checkpoint
+        return {
+            "id": entry["id"],
+            "gist": entry["gist"],
+            "job_id": workspace.new_job_id(),
+            "state": "pending",
+            "stages": {},
+            "timings": {},
+            "error": None,
+        }
+
+    def save_checkpoint(self, checkpoint):
+        fileutil.atomic_write_json(self.checkpoint_path(checkpoint["id"]), checkpoint, indent=2)
+
+    def run_story(self, entry):
+        """Run (or resume) the pipeline for one entry and return its final checkpoint"""
+        # Built on first use, so reading the input and --help work without API keys
+        pipeline = get_pipeline()
+        pdf_generator = pipeline.pdf
+
+        checkpoint = self.load_checkpoint(entry)
+        job_id = checkpoint["job_id"]
+        pdf_path = workspace.get_pdf_path(job_id)
+        if checkpoint["state"] == "done" and pdf_path.exists():
+            checkpoint["resumed"] = "skipped"
+            return checkpoint
+
+        workspace.create_workspace(job_id)
+        checkpoint.update(state="running", error=None, resumed=bool(checkpoint["stages"]))
+        stages = checkpoint["stages"]
+        timings = checkpoint["timings"]
+        profile = entry.get("profile") or self.profile or pdf_generator.DEFAULT_PDF_PROFILE
+        story_path = workspace.get_stories_dir(job_id) / "story.json"
+        started = time.time()
+
+        try:
+            # 1. Story: the saved story.json is the checkpoint of the LLM call
+            if not (stages.get("story") == "done" and story_path.exists()):
+                t = time.time()
+                fresh = self.fresh or str(entry.get("fresh", "")).lower() in ("1", "true", "yes")
+                story = pipeline.stories.generate_story_with_moral(entry["gist"], fresh=fresh)
+                if not story["pages"]:
+                    raise StoryError("The story came back without any pages")
+                pipeline.pages.split_pages(story, job_id=job_id)
+                timings["story"] = round(time.time() - t, 3)
+                stages["story"] = "done"
+                self.save_checkpoint(checkpoint)
+
+            # 2. Images: every finished page is stored encoded, so a rerun only renders the rest
+            t = time.time()
+            story_data = pipeline.pages.load_story(story_path)
+            page_store = workspace.get_pdf_pages_dir(job_id)
+            settings = fileutil.read_json(workspace.get_render_settings_path(job_id)) or {}
+            if settings.get("profile") != profile and page_store.exists():
+                # Pages encoded for another profile can't be reused
+                shutil.rmtree(page_store, ignore_errors=True)
+            engine_id = settings.get("engine_id") or pipeline.engine_id
+            save_render_settings(job_id, engine_id, profile)
+
+            page_keys = sorted((k for k in story_data if k.startswith("page_")), key=lambda x: int(x.split("_")[1]))
+            stored = {f"page_{index}" for index, _, _ in pdf_generator.load_encoded_pages(page_store)}
+            missing = [key for key in page_keys if key not in stored]
+            settings_profile = pdf_generator.get_profile(profile)
+
+            def on_page(key, page):
+                if page is None:
+                    return
+                data, filter_name, colorspace, (width, height) = page["pdf"]
+                pdf_generator.store_encoded_page(page_store, int(key.split("_")[1]), data, filter_name, colorspace,
+                                                 width, height, page["size"])
+
+            if missing:
+                print(f"[{entry['id']}] Rendering {len(missing)} of {len(page_keys)} pages...")
+                results = pipeline.images.generate_pages(engine_id, story_data, missing, workers=self.image_workers,
+                                                         out_dir=None, on_page=on_page, in_memory=True,
+                                                         keep_images=False, deadline=pipeline.images.book_deadline(),
+                                                         prepare={"pdf_profile": settings_profile},
+                                                         base_dir=workspace.get_bases_dir(job_id))
+                failed = [key for key, ok in results.items() if not ok]
+                if failed:
+                    raise ImageError(f"Failed to render {', '.join(failed)}")
+                timings["images"] = round(time.time() - t, 3)
+            stages["images"] = "done"
+            checkpoint["pages"] = len(page_keys)
+            self.save_checkpoint(checkpoint)
+
+            # 3. PDF, assembled from the stored pages without re-encoding them
+            t = time.time()
+            pdf_generator.rebuild_pdf(pdf_path, page_store, profile)
+            archive.archive_job(job_id, entry["gist"])
+            timings["pdf"] = round(time.time() - t, 3)
+            stages["pdf"] = "done"
+            checkpoint.update(state="done", pdf=str(pdf_path))
+        except Exception as e:
+            print(f"[{entry['id']}] Failed: {e}")
+            checkpoint.update(state="failed", error=str(e) or type(e).__name__)
+        finally:
+            checkpoint["seconds"] = round(time.time() - started, 3)
+            self.save_checkpoint(checkpoint)
+        return checkpoint
+
+    def run(self):
+        """Process every entry of the input file and write report.json. Returns the report."""
+        entries = read_gists(self.input_path)
+        print(f"Batch of {len(entries)} stories, {self.concurrency} at a time, checkpoints in {self.batch_dir}")
+        started = time.time()
+        results = {}
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="story") as executor:
+            futures = {executor.submit(self.run_story, entry): entry for entry in entries}
+            for future in as_completed(futures):
+                entry = futures[future]
+                try:
+                    checkpoint = future.result()
+                except Exception as e:
+                    checkpoint = {"id": entry["id"], "gist": entry["gist"], "state": "failed", "error": str(e)}
+                results[entry["id"]] = checkpoint
+                print(f"[{entry['id']}] {checkpoint['state']} ({len(results)}/{len(entries)})")
+
+        report = build_report([results[entry["id"]] for entry in entries], time.time() - started)
+        fileutil.atomic_write_json(self.batch_dir / "report.json", report, indent=2)
+        return report
+
+
+def build_report(checkpoints, elapsed):
+    """Summary of a batch run with the timings of each story"""
+    stories = []
+    for cp in checkpoints:
+        stories.append({
+            "id": cp["id"],
+            "job_id": cp.get("job_id"),
+            "state": cp["state"],
+            "resumed": cp.get("resumed", False),
+            "pages": cp.get("pages"),
+            "seconds": cp.get("seconds"),
+            "timings": cp.get("timings", {}),
+            "pdf": cp.get("pdf"),
+            "error": cp.get("error"),
+        })
+    done = [s for s in stories if s["state"] == "done"]
+    # Books skipped as already finished don't count towards this run's throughput
+    built = [s for s in done if s["resumed"] != "skipped"]
+    return {
+        "total": len(stories),
+        "done": len(done),
+        "failed": len(stories) - len(done),
+        "skipped": len(done) - len(built),
+        "elapsed": round(elapsed, 3),
+        "books_per_minute": round(len(built) * 60 / elapsed, 2) if elapsed > 0 else None,
+        "stories": stories,
+    }
+
+def print_report(report):
+    print(f"\n{'id':<20} {'state':<8} {'pages':>5} {'story':>8} {'images':>8} {'pdf':>7} {'total':>8}")
+    for s in report["stories"]:
+        t = s["timings"]
+        cols = [t.get("story"), t.get("images"), t.get("pdf"), s["seconds"]]
+        cols = [f"{c:.1f}s" if c is not None else "-" for c in cols]
+        state = "skipped" if s["resumed"] == "skipped" else s["state"]
+        print(f"{s['id']:<20} {state:<8} {s['pages'] or '-':>5} {cols[0]:>8} {cols[1]:>8} {cols[2]:>7} {cols[3]:>8}")
+    print(f"\n{report['done']}/{report['total']} books done ({report['skipped']} already finished), "
+          f"{report['failed']} failed in {report['elapsed']:.1f}s ({report['books_per_minute']} books/min)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a storybook for every gist in a JSONL or CSV file.")
+    parser.add_argument("input", help="JSONL (one {\"gist\": ...} or string per line) or CSV with a gist column; "
+                                      "an optional id field names each story")
+    parser.add_argument("--batch-dir", help="folder for checkpoints and report.json (default output/batches/<input name>)")
+    parser.add_argument("-j", "--concurrency", type=int, default=BATCH_CONCURRENCY, help="stories generated at once")
+    parser.add_argument("--image-workers", type=int, help="page images generated at once per story")
+    parser.add_argument("--profile", help="PDF profile: web, print or thumbnail")
+    parser.add_argument("--fresh", action="store_true", help="skip the story cache for new stories")
+    args = parser.parse_args(argv)
+
+    run = BatchRun(args.input, args.batch_dir, concurrency=args.concurrency, profile=args.profile,
+                   fresh=args.fresh, image_workers=args.image_workers)
+    report = run.run()
+    print_report(report)
+    print(f"Report saved at {run.batch_dir / 'report.json'}")
+    return 0 if not report["failed"] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
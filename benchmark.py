@@ -0,0 +1,431 @@
+"""End-to-end benchmark against local stand-ins for the OpenAI and Stability APIs
+
+    python benchmark.py web --users 4 --books 20
+    python benchmark.py batch --users 4 --books 20 --image-latency 2 --image-error-rate 0.05
+
+The fake servers run in a child process, so the peak RSS reported is the pipeline's
+own: the benchmark process and its render pool workers. Caches and rate limits are off and all output goes to a temporary folder, so
+every book goes through the full story -> images -> PDF path.
+"""
+import argparse
+import base64
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+ENGINE_ID = "stable-diffusion-xl-1024-v1-0"
+STAGE_ORDER = ["queue_wait", "llm", "llm_stream", "parse", "llm_repair", "split_pages", "generate_image",
+               "add_text", "pdf_encode", "pdf", "archive"]
+
+
+def canned_story(gist, pages):
+    """A story in the line format gist_to_story expects"""
+    lines = [
+        f"TITLE: The Tale of {gist.title()}",
+        "",
+        f"STORY_OVERVIEW: A bright meadow where {gist} learn to share and play together.",
+        "",
+        "CHARACTER:",
+        "NAME: Pip",
+        "DESCRIPTION: a small striped zebra with a red scarf",
+    ]
+    for i in range(1, pages + 1):
+        lines += [
+            "",
+            "PAGE:",
+            f"TEXT: On day {i}, Pip met a new friend by the river. They laughed, shared berries "
+            f"and watched the clouds drift by until the sun went down.",
+            f"SCENE: Pip and a friend sitting by a sparkling river on day {i}, soft evening light",
+        ]
+    lines += ["", "MORAL: Friends are found when we share what we have."]
+    return "\n".join(lines) + "\n"
+
+def make_pngs(count=4, size=1024):
+    """A few distinct illustration-like PNGs, so overlay placement and JPEG encoding see real work"""
+    from PIL import Image, ImageDraw
+
+    pngs = []
+    for n in range(count):
+        rng = random.Random(n)
+        img = Image.new("RGB", (size, size))
+        draw = ImageDraw.Draw(img)
+        top = tuple(rng.randrange(120, 256) for _ in range(3))
+        bottom = tuple(rng.randrange(0, 160) for _ in range(3))
+        for y in range(size):
+            t = y / size
+            draw.line([(0, y), (size, y)], fill=tuple(int(a + (b - a) * t) for a, b in zip(top, bottom)))
+        for _ in range(40):
+            x, y, r = rng.randrange(size), rng.randrange(size), rng.randrange(10, 120)
+            draw.ellipse([x - r, y - r, x + r, y + r], fill=tuple(rng.randrange(256) for _ in range(3)))
+        buf = io.BytesIO()
+        img.save(buf, "PNG")
+        pngs.append(base64.b64encode(buf.getvalue()).decode("ascii"))
+    return pngs
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """Serves /v1/chat/completions (OpenAI) and /v1/engines/list + text-to-image (Stability)"""
+
+    protocol_version = "HTTP/1.1"
+    config = {}
+    pngs = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, obj, status=200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path.endswith("/engines/list"):
+            return self._send_json([{"id": ENGINE_ID, "name": "SDXL 1.0", "type": "PICTURE"}])
+        self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        body = self._read_json()
+        if self.path.endswith("/chat/completions"):
+            return self._chat(body)
+        if self.path.endswith("/text-to-image"):
+            return self._text_to_image(body)
+        self._send_json({"error": "not found"}, 404)
+
+    def _chat(self, body):
+        delay = self.config["llm_delay"]
+        prompt = body["messages"][-1]["content"]
+        if body.get("response_format", {}).get("type") == "json_object":
+            content = "{}"
+        else:
+            gist = prompt.split("about:", 1)[-1].split("\n", 1)[0].strip() or "friends"
+            content = canned_story(gist, self.config["pages"])
+        base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": body.get("model", "")}
+
+        if not body.get("stream"):
+            time.sleep(delay)
+            return self._send_json(dict(base, object="chat.completion", choices=[{
+                "index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop",
+            }], usage={"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}))
+
+        # Spread the delay over the chunks, like tokens arriving
+        chunks = [content[i:i + 40] for i in range(0, len(content), 40)]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for i, text in enumerate(chunks):
+            time.sleep(delay / len(chunks))
+            chunk = dict(base, object="chat.completion.chunk", choices=[{
+                "index": 0, "delta": {"content": text}, "finish_reason": None,
+            }])
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def _text_to_image(self, body):
+        latency = self.config["image_latency"]
+        time.sleep(max(0.0, random.gauss(latency, latency * 0.2)))
+        if random.random() < self.config["image_error_rate"]:
+            return self._send_json({"message": "fake server error"}, 500)
+        prompt = body["text_prompts"][0]["text"]
+        png = self.pngs[int(hashlib.md5(prompt.encode("utf-8")).hexdigest(), 16) % len(self.pngs)]
+        self._send_json({"artifacts": [{"base64": png, "finishReason": "SUCCESS", "seed": 0}]})
+
+def serve_fake_apis(config, ports):
+    """Child process entry point: run the fake API server and report its port"""
+    FakeApiHandler.config = config
+    FakeApiHandler.pngs = make_pngs()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeApiHandler)
+    server.daemon_threads = True
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+def start_fake_apis(config):
+    """Start the fake servers in a child process. Returns (process, base URL)."""
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve_fake_apis, args=(config, ports), daemon=True)
+    process.start()
+    return process, f"http://127.0.0.1:{ports.get(timeout=60)}"
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def process_rss_mb(pid):
+    """Current RSS of a process from /proc (Linux), or None"""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+def child_pids():
+    """Pids of this process's children, from /proc (empty elsewhere)"""
+    me = os.getpid()
+    pids = []
+    for entry in os.listdir("/proc") if os.path.isdir("/proc") else []:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The ppid follows the parenthesised command name, which may contain spaces
+                if int(f.read().rsplit(")", 1)[1].split()[1]) == me:
+                    pids.append(int(entry))
+        except (OSError, ValueError, IndexError):
+            continue
+    return pids
+
+
+class RssSampler:
+    """Samples the RSS of this process and its render workers (Linux only)
+
+    The render pool workers are children of this process; the fake API server is
+    left out. RUSAGE_CHILDREN is no help here: it only covers children already
+    waited for, and on Linux a short fork+exec helper (platform runs `uname`) keeps
+    the forked parent's peak. The peaks stay None where /proc is not available.
+    """
+
+    def __init__(self, exclude=(), interval=0.25):
+        self.exclude = set(exclude)
+        self.interval = interval
+        self.peak = None
+        self.workers_peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="rss")
+
+    def sample(self):
+        main = process_rss_mb(os.getpid())
+        if main is None:
+            return
+        workers = sum(process_rss_mb(pid) or 0.0 for pid in child_pids() if pid not in self.exclude)
+        self.workers_peak = max(self.workers_peak or 0.0, workers)
+        self.peak = max(self.peak or 0.0, main + workers)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+class StageRecorder:
+    """Collects every stage timing observed through metrics, for exact percentiles"""
+
+    def __init__(self):
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name, labels, value):
+        if name == "storybook_stage_seconds":
+            with self._lock:
+                self.samples.setdefault(labels["stage"], []).append(value)
+
+    def summary(self):
+        with self._lock:
+            stages = sorted(self.samples, key=lambda s: (STAGE_ORDER.index(s) if s in STAGE_ORDER else len(STAGE_ORDER), s))
+            return {stage: summarize(self.samples[stage]) for stage in stages}
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+    }
+
+
+def run_web(args):
+    """N users each submit books through /generate and poll /status until they finish"""
+    import requests
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    import app
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", 0, app.app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    latencies, failures = [], []
+    lock = threading.Lock()
+    counter = iter(range(args.books))
+
+    def user(n):
+        session = requests.Session()
+        while True:
+            with lock:
+                book = next(counter, None)
+            if book is None:
+                return
+            started = time.time()
+            while True:
+                resp = session.post(f"{base_url}/generate", data={"gist": f"zebra and tiger, book {book}"},
+                                    headers={"Accept": "application/json"})
+                if resp.status_code != 429:
+                    break
+                time.sleep(min(5, int(resp.headers.get("Retry-After", "1"))))
+            resp.raise_for_status()
+            status_url = base_url + resp.json()["status_url"]
+            while True:
+                status = session.get(status_url).json()
+                if status["state"] in ("done", "failed"):
+                    break
+                time.sleep(args.poll)
+            with lock:
+                if status["state"] == "done":
+                    latencies.append(time.time() - started)
+                else:
+                    failures.append(status.get("error"))
+
+    threads = [threading.Thread(target=user, args=(n,)) for n in range(args.users)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    server.shutdown()
+    return latencies, failures
+
+def run_batch(args):
+    """The batch CLI path over a generated JSONL of gists, --users stories at a time"""
+    import batch
+
+    gists_path = Path(os.environ["BATCHES_DIR"]) / "bench.jsonl"
+    gists_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(gists_path, "w", encoding="utf-8") as f:
+        for book in range(args.books):
+            f.write(json.dumps({"id": f"book{book}", "gist": f"zebra and tiger, book {book}"}) + "\n")
+
+    report = batch.BatchRun(gists_path, concurrency=args.users).run()
+    latencies = [s["seconds"] for s in report["stories"] if s["state"] == "done"]
+    failures = [s["error"] for s in report["stories"] if s["state"] != "done"]
+    return latencies, failures
+
+def print_results(results):
+    print(f"\n{results['mode']} mode: {results['books']} books, {results['users']} concurrent users")
+    print(f"{'stage':<16} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+    rows = list(results["stages"].items()) + [("book (end-to-end)", results["latency"])]
+    for stage, s in rows:
+        cols = [f"{s[p]:.3f}s" if s[p] is not None else "-" for p in ("p50", "p95", "p99")]
+        print(f"{stage:<16} {s['count']:>6} {cols[0]:>9} {cols[1]:>9} {cols[2]:>9}")
+    print(f"\n{results['done']} done, {results['failed']} failed in {results['elapsed']:.1f}s: "
+          f"{results['books_per_minute']:.2f} books/min")
+    sampled = [results[k] for k in ("peak_worker_rss_mb", "peak_total_rss_mb")]
+    workers, total = [f"{mb:.0f} MB" if mb is not None else "n/a" for mb in sampled]
+    print(f"peak RSS: {results['peak_rss_mb']:.0f} MB main process, {workers} render workers, {total} all together")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the storybook pipeline against fake API servers.")
+    parser.add_argument("mode", choices=["web", "batch"], help="drive /generate or the batch CLI path")
+    parser.add_argument("-u", "--users", type=int, default=4, help="concurrent users (web) or stories (batch)")
+    parser.add_argument("-n", "--books", type=int, default=8, help="books to generate in total")
+    parser.add_argument("--pages", type=int, default=6, help="story pages per book")
+    parser.add_argument("--llm-delay", type=float, default=1.0, help="seconds per chat completion")
+    parser.add_argument("--image-latency", type=float, default=1.0, help="mean seconds per generated image")
+    parser.add_argument("--image-error-rate", type=float, default=0.0, help="fraction of image requests failing with 500")
+    parser.add_argument("--poll", type=float, default=0.2, help="status polling interval (web mode)")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary output folder")
+    args = parser.parse_args(argv)
+
+    fake, base_url = start_fake_apis({
+        "llm_delay": args.llm_delay,
+        "image_latency": args.image_latency,
+        "image_error_rate": args.image_error_rate,
+        "pages": args.pages,
+    })
+    out_dir = Path(tempfile.mkdtemp(prefix="storybook-bench-"))
+
+    # Must be set before the pipeline modules are imported
+    os.environ.update({
+        "OPENAI_BASE_URL": f"{base_url}/v1",
+        "OPENAI_API_KEY": "bench",
+        "STABILITY_API_HOST": base_url,
+        "STABILITY_API_KEY": "bench",
+        "JOBS_DIR": str(out_dir / "jobs"),
+        "BATCHES_DIR": str(out_dir / "batches"),
+        "ENGINE_CACHE_PATH": str(out_dir / "engines.json"),
+        "ARCHIVE_DIR": str(out_dir / "archive"),
+        # Every benchmark book must be generated, not served from the archive
+        "SIMILAR_GISTS": "off",
+        "IMAGE_CACHE": "0",
+        "STORY_CACHE": "0",
+        "RATE_LIMIT": "0",
+        "JOB_WORKERS": os.environ.get("JOB_WORKERS", str(args.users)),
+        "JOB_QUEUE_SIZE": os.environ.get("JOB_QUEUE_SIZE", str(max(args.books, 1))),
+    })
+    import metrics
+
+    recorder = StageRecorder()
+    metrics.add_listener(recorder)
+    started = time.time()
+    try:
+        with RssSampler(exclude=[fake.pid]) as rss:
+            latencies, failures = (run_web if args.mode == "web" else run_batch)(args)
+    finally:
+        elapsed = time.time() - started
+        metrics.remove_listener(recorder)
+        fake.terminate()
+        if not args.keep:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+    results = {
+        "mode": args.mode,
+        "users": args.users,
+        "books": args.books,
+        "done": len(latencies),
+        "failed": len(failures),
+        "errors": failures,
+        "elapsed": elapsed,
+        "books_per_minute": len(latencies) * 60 / elapsed if elapsed > 0 else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_worker_rss_mb": rss.workers_peak,
+        "peak_total_rss_mb": rss.peak,
+        "latency": summarize(latencies),
+        "stages": recorder.summary(),
+    }
+    print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0 if not failures else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,36 @@
+import json
+import os
+import tempfile
+from pathlib import Path
+
+def atomic_write_bytes(path, data):
+    """Write bytes to path via a temp file in the same folder plus rename"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+
+def atomic_write_json(path, obj, **dump_kwargs):
+    """Serialize obj as JSON and write it atomically"""
+    dump_kwargs.setdefault("ensure_ascii", False)
+    data = json.dumps(obj, **dump_kwargs).encode("utf-8")
+    atomic_write_bytes(path, data)
+
+def read_json(path, default=None):
+    """Read a JSON file, returning default if it is missing or unreadable"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
@@ -0,0 +1,92 @@
+import hashlib
+import os
+import random
+import re
+
+# Books whose gist (or title) is at least this similar (Jaccard over stemmed words) count as a match.
+# "zebra and tiger playing chess" vs "a zebra & tiger play chess" is 1.0, "a cat who learns to swim"
+# vs "a dog who learns to swim" 0.6, and one extra word in a four-word gist 0.8.
+SIMILAR_GIST_THRESHOLD = float(os.getenv("SIMILAR_GIST_THRESHOLD", "0.75"))
+# For the web form: "offer" shows the existing book and lets the user generate anyway, "serve" returns
+# it right away when the gist has exactly the same words (other matches are offered), "off" always generates.
+# JSON clients opt in per request with a similar=offer|serve field.
+SIMILAR_GISTS = os.getenv("SIMILAR_GISTS", "offer")
+
+# MinHash signature split into BANDS bands of ROWS values for the LSH lookup.
+# 21 bands of 3 rows: pairs at 0.6 similarity share a band >99% of the time, at 0.2 ~15%.
+BANDS = 21
+ROWS = 3
+# Bumped when shingles() changes, so archives index their books again
+INDEX_VERSION = 2
+NUM_PERM = BANDS * ROWS
+_PRIME = (1 << 61) - 1
+_rng = random.Random(1234)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+# Words that don't change what a story is about
+STOPWORDS = {
+    "a", "an", "the", "and", "of", "to", "in", "on", "with", "for", "at", "is", "are",
+    "story", "book", "storybook", "about", "tale",
+}
+
+def normalize(text):
+    """Lowercase words without punctuation, stopwords or '&'"""
+    text = text.lower().replace("&", " and ")
+    words = re.findall(r"[a-z0-9]+", text)
+    return " ".join(w for w in words if w not in STOPWORDS)
+
+def stem(word):
+    """Lightly stemmed word: playing/played/plays -> play, bunnies -> bunny, dance/dancing -> danc"""
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    for suffix in ("ing", "ed"):
+        if len(word) > len(suffix) + 2 and word.endswith(suffix):
+            word = word[:-len(suffix)]
+            # swimming -> swim, but not fall -> fal
+            if len(word) > 2 and word[-1] == word[-2] and word[-1] not in "lsz":
+                word = word[:-1]
+            break
+    else:
+        if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+            word = word[:-1]
+    if len(word) > 3 and word.endswith("e"):
+        word = word[:-1]
+    return word
+
+def shingles(text):
+    """Stemmed words of the normalized text"""
+    return {stem(w) for w in normalize(text).split()}
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def signature(shingle_set):
+    """MinHash signature of a shingle set"""
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+              for s in shingle_set]
+    if not hashes:
+        return []
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+def band_keys(text):
+    """(band, bucket) pairs under which a text is indexed; similar texts share at least one"""
+    sig = signature(shingles(text))
+    if not sig:
+        return []
+    keys = []
+    for band in range(BANDS):
+        rows = sig[band * ROWS:(band + 1) * ROWS]
+        keys.append((band, hashlib.blake2b(repr(rows).encode("ascii"), digest_size=8).hexdigest()))
+    return keys
+
+def same_words(a, b):
+    """Whether two texts have the same words, ignoring case, punctuation, order, stopwords and word endings"""
+    words = shingles(a)
+    return bool(words) and words == shingles(b)
+
+def similarity(query, *texts):
+    """Best Jaccard similarity between the query and any of texts"""
+    query_shingles = shingles(query)
+    return max((jaccard(query_shingles, shingles(t)) for t in texts if t), default=0.0)
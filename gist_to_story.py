@@ -1,13 +1,27 @@
+import json
+import os
+
 from dotenv import load_dotenv
 from openai import OpenAI
 
+import metrics
+import ratelimit
+import story_cache
+
 load_dotenv()
 client = OpenAI()
 
-def generate_story_with_moral(gist, max_chars=1000):
-    """Generate a children's story from a gist using OpenAI"""
-    
-    prompt = f"""
+MODEL = "gpt-4o-mini"
+TEMPERATURE = 0.9
+# Bump whenever the prompt below changes so cached stories are not reused
+PROMPT_VERSION = 1
+# Ask for just the missing parts of an incomplete story instead of dropping them
+REPAIR_STORIES = os.getenv("REPAIR_STORIES", "1") != "0"
+REPAIR_TEMPERATURE = 0.7
+
+def build_story_prompt(gist, max_chars=1000):
+    """Prompt asking for a story in the line format parse_story understands"""
+    return f"""
 Write a children's picture book story for ages 3-7 about: {gist}
 
 Rules:
@@ -36,61 +50,313 @@ SCENE: ...
 MORAL: ...
 """
 
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.9
-    )
+class StoryParser:
+    """Incremental parser for the TITLE/STORY_OVERVIEW/CHARACTER/PAGE/MORAL line format
 
-    raw = response.choices[0].message.content.strip()
-    lines = [l.strip() for l in raw.split("\n") if l.strip()]
+    Feed it text as it arrives. on_title(story) fires once the title page fields are
+    complete (at the first PAGE line) and on_page(number, page, story) fires as soon as
+    a page has both its TEXT and SCENE lines. Pages missing one of them are kept in
+    draft() so they can be repaired instead of silently dropped.
+    """
+
+    def __init__(self, on_title=None, on_page=None):
+        self.on_title = on_title
+        self.on_page = on_page
+        self.title = ""
+        self.story_overview = ""
+        self.character = {}
+        self.pages = []
+        self.moral = ""
+        self.done = False
+        self._buffer = ""
+        self._drafts = []
+        self._current = None
+        self._title_sent = False
+
+    def feed(self, chunk):
+        """Consume a piece of the completion, parsing every complete line"""
+        if self.done or not chunk:
+            return
+        self._buffer += chunk
+        while "\n" in self._buffer and not self.done:
+            line, self._buffer = self._buffer.split("\n", 1)
+            self._parse_line(line)
+
+    def close(self):
+        """Parse whatever is left in the buffer and return the story dict"""
+        if self._buffer and not self.done:
+            self._parse_line(self._buffer)
+        self._buffer = ""
+        self.done = True
+        return self.result()
+
+    def result(self):
+        return {
+            "title": self.title,
+            "story_overview": self.story_overview,
+            "pages": list(self.pages),
+            "character": dict(self.character),
+            "moral": self.moral
+        }
+
+    def draft(self):
+        """The story including incomplete pages (missing fields are empty strings)"""
+        story = self.result()
+        story["pages"] = [
+            {"text": d["text"], "scene": d["scene"]}
+            for d in self._drafts if d["text"] or d["scene"]
+        ]
+        return story
+
+    def _emit_title(self):
+        if not self._title_sent:
+            self._title_sent = True
+            if self.on_title:
+                self.on_title(self.result())
 
-    title = ""
-    story_overview = ""
-    character = {}
-    pages = []
-    moral = ""
+    def _start_page(self):
+        self._current = {"text": "", "scene": "", "complete": False}
+        self._drafts.append(self._current)
 
-    text = ""
-    scene = ""
+    def _set_page_field(self, field, value):
+        # TEXT/SCENE after a finished page without a PAGE line starts a new page
+        if self._current is None or self._current["complete"]:
+            self._start_page()
+        self._current[field] = value
+        if self._current["text"] and self._current["scene"]:
+            self._current["complete"] = True
+            page = {"text": self._current["text"], "scene": self._current["scene"]}
+            self.pages.append(page)
+            if self.on_page:
+                self.on_page(len(self.pages), page, self.result())
 
-    for line in lines:
+    def _parse_line(self, line):
+        line = line.strip()
+        if not line:
+            return
         low = line.lower()
 
         if low.startswith("title:"):
-            title = line[6:].strip()
+            self.title = line[6:].strip()
 
         elif low.startswith("story_overview:"):
-            story_overview = line[15:].strip()
+            self.story_overview = line[15:].strip()
 
         elif low.startswith("name:"):
-            character["name"] = line[5:].strip()
+            self.character["name"] = line[5:].strip()
 
         elif low.startswith("description:"):
-            character["description"] = line[12:].strip()
+            self.character["description"] = line[12:].strip()
 
         elif low.startswith("page"):
-            if text and scene:
-                pages.append({"text": text, "scene": scene})
-            text = ""
-            scene = ""
+            self._emit_title()
+            self._start_page()
 
         elif low.startswith("text:"):
-            text = line[5:].strip()
+            self._set_page_field("text", line[5:].strip())
 
         elif low.startswith("scene:"):
-            scene = line[6:].strip()
+            self._set_page_field("scene", line[6:].strip())
 
         elif low.startswith("moral:"):
-            if text and scene:
-                pages.append({"text": text, "scene": scene})
-            moral = line[6:].strip()
-            break
-
-    return {
-        "title": title,
-        "story_overview": story_overview,
-        "pages": pages,
-        "character": character,
-        "moral": moral
-    }
\ No newline at end of file
+            self._emit_title()
+            self.moral = line[6:].strip()
+            self.done = True
+
+def parse_story(raw, include_incomplete=False):
+    """Parse the TITLE/STORY_OVERVIEW/CHARACTER/PAGE/MORAL lines of a completion
+
+    Pages lacking TEXT or SCENE are dropped unless include_incomplete is True.
+    """
+    parser = StoryParser()
+    parser.feed(raw)
+    story = parser.close()
+    return parser.draft() if include_incomplete else story
+
+def validate_story(story):
+    """List the missing or incomplete parts of a parsed story (empty if it is complete)"""
+    problems = []
+    for field in ("title", "story_overview", "moral"):
+        if not story.get(field):
+            problems.append(field)
+    character = story.get("character") or {}
+    for field in ("name", "description"):
+        if not character.get(field):
+            problems.append(f"character.{field}")
+    pages = story.get("pages") or []
+    if not pages:
+        problems.append("pages")
+    for i, page in enumerate(pages):
+        for field in ("text", "scene"):
+            if not page.get(field):
+                problems.append(f"pages[{i}].{field}")
+    return problems
+
+def build_repair_prompt(gist, story, problems, max_chars=1000):
+    """Prompt asking only for the missing parts of a partly parsed story"""
+    return f"""
+A children's picture book story for ages 3-7 about "{gist}" came back with parts missing.
+Here is what we have, as JSON (empty strings are missing):
+
+{json.dumps(story, indent=2, ensure_ascii=False)}
+
+Missing: {", ".join(problems)}
+
+Write ONLY the missing parts, consistent with the rest of the story. Reply with a JSON object
+containing just those fields, using the same keys:
+- "title", "story_overview", "moral": strings
+- "character": {{"name": ..., "description": ...}}
+- "pages": [{{"index": <position in the pages list, from 0>, "text": ..., "scene": ...}}]
+If there are no pages at all, write short pages (3-4 sentences each, about {max_chars} characters
+in total) numbered from index 0. TEXT is what is read aloud; SCENE describes the illustration.
+"""
+
+def merge_repair(story, patch):
+    """Fill only the empty fields of story from a repair response; drop pages still incomplete"""
+    story = dict(story, character=dict(story.get("character") or {}), pages=[dict(p) for p in story.get("pages", [])])
+
+    for field in ("title", "story_overview", "moral"):
+        if not story.get(field) and isinstance(patch.get(field), str):
+            story[field] = patch[field].strip()
+
+    patch_character = patch.get("character")
+    if isinstance(patch_character, dict):
+        for field in ("name", "description"):
+            if not story["character"].get(field) and isinstance(patch_character.get(field), str):
+                story["character"][field] = patch_character[field].strip()
+
+    for fix in patch.get("pages") or []:
+        if not isinstance(fix, dict):
+            continue
+        index = fix.get("index")
+        if not isinstance(index, int) or index < 0:
+            continue
+        while index >= len(story["pages"]):
+            story["pages"].append({"text": "", "scene": ""})
+        page = story["pages"][index]
+        for field in ("text", "scene"):
+            if not page.get(field) and isinstance(fix.get(field), str):
+                page[field] = fix[field].strip()
+
+    story["pages"] = [p for p in story["pages"] if p.get("text") and p.get("scene")]
+    return story
+
+def repair_story(gist, story, problems=None, max_chars=1000):
+    """Fill the missing parts of a story with one small follow-up completion"""
+    if problems is None:
+        problems = validate_story(story)
+    if not problems:
+        return story
+
+    print(f"Repairing story, missing: {', '.join(problems)}")
+    try:
+        ratelimit.acquire("openai")
+        with metrics.timed("llm_repair"):
+            response = client.chat.completions.create(
+                model=MODEL,
+                messages=[{"role": "user", "content": build_repair_prompt(gist, story, problems, max_chars)}],
+                temperature=REPAIR_TEMPERATURE,
+                response_format={"type": "json_object"}
+            )
+        patch = json.loads(response.choices[0].message.content)
+    except Exception as e:
+        print(f"Warning: Failed to repair story: {e}")
+        patch = {}
+
+    if not isinstance(patch, dict):
+        patch = {}
+    return merge_repair(story, patch)
+
+def finish_story(gist, parser, max_chars=1000):
+    """Parsed story from a finished parser, repaired if parts are missing"""
+    story = parser.close()
+    draft = parser.draft()
+    problems = validate_story(draft)
+    if problems and REPAIR_STORIES:
+        return repair_story(gist, draft, problems, max_chars)
+    return story
+
+def replay_story(story, on_title=None, on_page=None):
+    """Fire the StoryParser callbacks for an already parsed story"""
+    if on_title:
+        on_title(story)
+    if on_page:
+        for number, page in enumerate(story["pages"], start=1):
+            on_page(number, page, story)
+
+def generate_story_with_moral(gist, max_chars=1000, fresh=False):
+    """Generate a children's story from a gist using OpenAI
+
+    Results are cached per normalized gist; pass fresh=True to ask for a new variation.
+    """
+    key = story_cache.cache_key(gist, max_chars, MODEL, TEMPERATURE, PROMPT_VERSION)
+    if not fresh:
+        cached = story_cache.load(key)
+        if cached:
+            return cached["story"]
+
+    prompt = build_story_prompt(gist, max_chars)
+
+    ratelimit.acquire("openai")
+    with metrics.timed("llm"):
+        response = client.chat.completions.create(
+            model=MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=TEMPERATURE
+        )
+
+    raw = response.choices[0].message.content.strip()
+    parser = StoryParser()
+    with metrics.timed("parse"):
+        parser.feed(raw)
+    story = finish_story(gist, parser, max_chars)
+
+    # Only keep complete stories around, so a failed repair is tried again next time
+    if not validate_story(story):
+        story_cache.store(key, raw, story)
+
+    return story
+
+def stream_story_with_moral(gist, max_chars=1000, fresh=False, on_title=None, on_page=None):
+    """Like generate_story_with_moral, but streams the completion and parses it line by line
+
+    on_title and on_page (see StoryParser) fire while the rest of the story is still
+    being written, so callers can start on the illustrations early.
+    """
+    key = story_cache.cache_key(gist, max_chars, MODEL, TEMPERATURE, PROMPT_VERSION)
+    if not fresh:
+        cached = story_cache.load(key)
+        if cached:
+            replay_story(cached["story"], on_title, on_page)
+            return cached["story"]
+
+    prompt = build_story_prompt(gist, max_chars)
+
+    ratelimit.acquire("openai")
+    stream = client.chat.completions.create(
+        model=MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=TEMPERATURE,
+        stream=True
+    )
+
+    parser = StoryParser(on_title=on_title, on_page=on_page)
+    chunks = []
+    # Parsing happens while the completion streams in, so it is timed with the call
+    with metrics.timed("llm_stream"):
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.content
+            if content:
+                chunks.append(content)
+                parser.feed(content)
+
+    raw = "".join(chunks).strip()
+    story = finish_story(gist, parser, max_chars)
+
+    # Only keep complete stories around, so a failed repair is tried again next time
+    if not validate_story(story):
+        story_cache.store(key, raw, story)
+
+    return story
@@ -0,0 +1,110 @@
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import ratelimit
+
+# Connections kept open per host
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+# Extra attempts after the first one for retryable failures
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "4"))
+# First backoff delay in seconds, doubled on every retry
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "1.0"))
+HTTP_MAX_BACKOFF = float(os.getenv("HTTP_MAX_BACKOFF", "60"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """Process-wide requests session with a keep-alive connection pool"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, response=None):
+    """Delay before retry number `attempt` (0-based), honouring Retry-After"""
+    if response is not None:
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        if retry_after is not None:
+            return min(retry_after, HTTP_MAX_BACKOFF)
+    delay = HTTP_BACKOFF * (2 ** attempt)
+    # Full jitter keeps parallel pages from retrying in lockstep
+    return min(HTTP_MAX_BACKOFF, random.uniform(delay / 2, delay))
+
+def request_with_retry(method, url, max_retries=None, rate_limit=None, deadline=None, **kwargs):
+    """Send a request through the shared session, retrying 429/5xx and connection errors
+
+    If rate_limit names a ratelimit budget, every attempt waits for room in it first.
+    With a deadline (a time.time() value) no attempt runs past it: the timeout is cut
+    to the time left and no retry starts whose backoff would overrun it.
+    Returns the last response (which may still be an error status); raises the last
+    exception if every attempt failed to get a response at all.
+    """
+    if max_retries is None:
+        max_retries = HTTP_MAX_RETRIES
+    session = get_session()
+    host = urlsplit(url).hostname or ""
+
+    for attempt in range(max_retries + 1):
+        if rate_limit:
+            ratelimit.acquire(rate_limit)
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise requests.Timeout(f"Deadline passed before {method} {url}")
+            kwargs["timeout"] = min(kwargs.get("timeout") or remaining, remaining)
+        try:
+            resp = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.HTTP_REQUESTS.inc(host=host, status=e.__class__.__name__)
+            if attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            if deadline is not None and time.time() + delay >= deadline:
+                raise
+            metrics.HTTP_RETRIES.inc(host=host, reason=e.__class__.__name__)
+            print(f"Request failed ({e.__class__.__name__}), retrying in {delay:.1f}s...")
+            time.sleep(delay)
+            continue
+
+        metrics.HTTP_REQUESTS.inc(host=host, status=resp.status_code)
+        if resp.status_code not in RETRY_STATUSES or attempt >= max_retries:
+            return resp
+
+        delay = backoff_delay(attempt, resp)
+        if deadline is not None and time.time() + delay >= deadline:
+            return resp
+        metrics.HTTP_RETRIES.inc(host=host, reason=resp.status_code)
+
+        print(f"Got {resp.status_code} from {url}, retrying in {delay:.1f}s...")
+        resp.close()
+        time.sleep(delay)
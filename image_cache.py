@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+import fileutil
+import metrics
+
+BASE_DIR = Path(__file__).resolve().parent
+CACHE_DIR = Path(os.getenv("IMAGE_CACHE_DIR", BASE_DIR / "output" / "image_cache"))
+# Total size the cache may use before least recently used images are evicted
+CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_MB", "1024")) * 1024 * 1024
+CACHE_ENABLED = os.getenv("IMAGE_CACHE", "1") != "0"
+
+_evict_lock = threading.Lock()
+
+def cache_key(engine_id, prompt, width, height, steps, cfg_scale, seed):
+    """Hash of everything that determines the generated image"""
+    params = {
+        "engine_id": engine_id,
+        "prompt": prompt,
+        "width": width,
+        "height": height,
+        "steps": steps,
+        "cfg_scale": cfg_scale,
+        "seed": seed,
+    }
+    raw = json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+def get_cache_path(key):
+    """Cached clean base image for a key (two-level fan-out keeps folders small)"""
+    return CACHE_DIR / key[:2] / f"{key}.png"
+
+def load(key):
+    """Return the cached image bytes for key, or None on a miss"""
+    if not CACHE_ENABLED:
+        return None
+    path = get_cache_path(key)
+    try:
+        data = path.read_bytes()
+    except OSError:
+        metrics.CACHE_REQUESTS.inc(cache="image", result="miss")
+        return None
+    metrics.CACHE_REQUESTS.inc(cache="image", result="hit")
+    # Bump mtime so eviction treats this entry as recently used
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return data
+
+def store(key, data):
+    """Save clean (un-overlaid) image bytes under key"""
+    if not CACHE_ENABLED:
+        return
+    try:
+        fileutil.atomic_write_bytes(get_cache_path(key), data)
+    except OSError as e:
+        print(f"Warning: Failed to cache image: {e}")
+        return
+    evict()
+
+def evict(max_bytes=None):
+    """Remove least recently used entries until the cache fits in max_bytes"""
+    if max_bytes is None:
+        max_bytes = CACHE_MAX_BYTES
+    if not CACHE_DIR.exists():
+        return 0
+
+    with _evict_lock:
+        entries = []
+        total = 0
+        for path in CACHE_DIR.glob("*/*.png"):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        if total <= max_bytes:
+            return 0
+
+        removed = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
@@ -1,37 +1,116 @@
 import os
-import sys
-import requests
 import base64
+import hashlib
+import io
 import json
 import textwrap
-import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, as_completed, wait
+from functools import lru_cache, partial
 from pathlib import Path
 from dotenv import load_dotenv
 from PIL import Image, ImageDraw, ImageFont, ImageStat
 
+try:
+    import numpy as np
+except ImportError:  # text boxes fall back to the fixed top/bottom positions
+    np = None
+
+import archive
+import fileutil
+import http_client
+import image_cache
+import metrics
+import ratelimit
+import render_pool
+import workspace
+from pipeline import PipelineError
+from split_pages import load_story
+
 load_dotenv()
 
 # CONFIG VALUES
 API_KEY = os.getenv("STABILITY_API_KEY")
-API_HOST = "https://api.stability.ai"
+API_HOST = os.getenv("STABILITY_API_HOST", "https://api.stability.ai")
 WIDTH = 1024
 HEIGHT = 1024
 STEPS = 30
 SAMPLES = 1
+CFG_SCALE = 7
+# 0 lets the API pick a random seed
+SEED = int(os.getenv("STABILITY_SEED", "0"))
+# Number of pages generated concurrently (1 = serial)
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "8"))
+# Keep page images in memory from the API response to the PDF (job runs only)
+IN_MEMORY_PIPELINE = os.getenv("IN_MEMORY_PIPELINE", "1") != "0"
+# Also write finished page PNGs to the images folder in in-memory mode
+SAVE_PAGE_IMAGES = os.getenv("SAVE_PAGE_IMAGES", "0") != "0"
+# Small previews shown in the browser while the rest of the book renders
+PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", "360"))
+PREVIEW_FORMAT = os.getenv("PREVIEW_FORMAT", "webp")
+PREVIEW_QUALITY = int(os.getenv("PREVIEW_QUALITY", "70"))
+# Lossless WebP previews (PREVIEW_QUALITY then trades speed for size) and WebP effort, 0 fastest to 6 smallest
+PREVIEW_LOSSLESS = os.getenv("PREVIEW_LOSSLESS", "0") != "0"
+PREVIEW_WEBP_METHOD = int(os.getenv("PREVIEW_WEBP_METHOD", "4"))
+# zlib level of page PNGs, 0-9. Pillow's default of 6 costs several times the CPU of 1 for a slightly smaller file
+PAGE_PNG_COMPRESS_LEVEL = int(os.getenv("PAGE_PNG_COMPRESS_LEVEL", "1"))
+# Seconds a book has for its illustrations (0 = no limit); pages still missing then are given up
+BOOK_DEADLINE = float(os.getenv("BOOK_DEADLINE", "300"))
+# Longest single generation request
+IMAGE_TIMEOUT = float(os.getenv("IMAGE_TIMEOUT", "120"))
+# Send a duplicate request once a generation runs longer than this percentile of recent ones (0 = never)
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# Hedge delay in seconds until HEDGE_MIN_SAMPLES generations have been timed
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", "30"))
+HEDGE_MIN_SAMPLES = 20
+# Threads running generation requests and their hedges, shared by all books in the process
+HEDGE_POOL_SIZE = int(os.getenv("HEDGE_POOL_SIZE", "64"))
+# Consecutive failed generation requests (API or HTTP errors, not deadline expiry) after which an engine is skipped for ENGINE_FALLBACK_COOLDOWN seconds
+ENGINE_FALLBACK_AFTER = int(os.getenv("ENGINE_FALLBACK_AFTER", "2"))
+ENGINE_FALLBACK_COOLDOWN = float(os.getenv("ENGINE_FALLBACK_COOLDOWN", "300"))
+# Generations tried per page before it counts as failed
+PAGE_ATTEMPTS = int(os.getenv("PAGE_ATTEMPTS", "2"))
 
 # Project paths
 BASE_DIR = Path(__file__).resolve().parent
 STORIES_DIR = BASE_DIR / "stories"
-STORIES_ARCHIVE_DIR = BASE_DIR / "output" / "stories_archive"
 OUT_DIR = BASE_DIR / "static" / "images"
 PDF_DIR = BASE_DIR / "static" / "pdf"
 FONTS_DIR = BASE_DIR / "static" / "fonts"
 # Try to find a custom font or config
 CUSTOM_FONT_PATH = os.getenv("FONT_PATH")
-
-def get_latest_story_path():
-    """Get story.json from stories folder"""
-    story_path = STORIES_DIR / "story.json"
+TITLE_FONT_SIZE = 60
+STORY_FONT_SIZE = 36
+MORAL_FONT_SIZE = 32
+# "auto" moves text boxes to the calmest part of the picture, "fixed" keeps them top/bottom
+TEXT_PLACEMENT = os.getenv("TEXT_PLACEMENT", "auto")
+if TEXT_PLACEMENT == "auto" and np is None:
+    print("Warning: numpy is not installed, text boxes use fixed placement")
+# Placement is scored on a copy of the page shrunk by this factor
+PLACEMENT_SCALE = 4
+# Spacing between candidate box positions, in pixels of the full page
+PLACEMENT_STEP = 16
+# Score penalty per pixel moved away from the default position
+PLACEMENT_DISTANCE_WEIGHT = 0.02
+# Engine list is refreshed from the API at most this often (seconds)
+ENGINE_CACHE_TTL = int(os.getenv("ENGINE_CACHE_TTL", "3600"))
+ENGINE_CACHE_PATH = Path(os.getenv("ENGINE_CACHE_PATH", BASE_DIR / "output" / "cache" / "engines.json"))
+
+_engines_cache = {"engines": None, "fetched": 0.0}
+_engines_lock = threading.Lock()
+
+# Durations of recent successful generations, for the hedge delay
+_latencies = deque(maxlen=200)
+# engine_id -> (consecutive failures, time of the last one)
+_engine_failures = {}
+_health_lock = threading.Lock()
+_request_executor = None
+
+def get_latest_story_path(job_id=None):
+    """Get story.json from stories folder (or the job's own story folder)"""
+    story_path = workspace.get_stories_dir(job_id) / "story.json"
     
     if not story_path.exists():
         print(f"Story file not found at {story_path}")
@@ -40,73 +119,77 @@ def get_latest_story_path():
     print(f"Found story: {story_path}")
     return story_path
 
-def get_story_folder_for_path(story_path):
-    """Get the story folder from a story.json path"""
-    return story_path.parent
-
-def archive_story(story_path):
-    """Move story files to archive directory after images are generated"""
-    try:
-        story_folder = get_story_folder_for_path(story_path)
-        
-        # Create archive directory if it doesn't exist
-        STORIES_ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
-        
-        # Create a timestamped archive folder
-        from datetime import datetime
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        archive_destination = STORIES_ARCHIVE_DIR / f"story_{timestamp}"
-        archive_destination.mkdir(parents=True, exist_ok=True)
-        
-        # Move only story-related files to archive (avoid moving unrelated files)
-        import shutil
-        patterns = ["story.json", "metadata.json", "story_structured.json", "page_*.json"]
-        for pattern in patterns:
-            for file in story_folder.glob(pattern):
-                if file.is_file():
-                    shutil.move(str(file), str(archive_destination / file.name))
-        
-        print(f"✓ Story archived to: {archive_destination}")
-        return True
-    except Exception as e:
-        print(f"Warning: Failed to archive story: {e}")
-        return False
-
-
-
-def setup_environment():
+def setup_environment(job_id=None):
     """Ensure API key is present and output directory exists."""
     if not API_KEY:
-        print("Error: STABILITY_API_KEY environment variable not set.")
-        print("Please set it in your .env file or export it.")
-        sys.exit(1)
+        raise PipelineError("STABILITY_API_KEY environment variable not set. "
+                            "Please set it in your .env file or export it.")
     
-    OUT_DIR.mkdir(parents=True, exist_ok=True)
-    PDF_DIR.mkdir(parents=True, exist_ok=True)
+    if job_id is None:
+        OUT_DIR.mkdir(parents=True, exist_ok=True)
+        PDF_DIR.mkdir(parents=True, exist_ok=True)
+    else:
+        workspace.create_workspace(job_id)
 
-def list_engines():
+def fetch_engines():
     """List available engines from Stability AI API."""
     url = f"{API_HOST}/v1/engines/list"
     try:
-        resp = requests.get(url, headers={"Authorization": f"Bearer {API_KEY}"}, timeout=30)
+        resp = http_client.request_with_retry("GET", url, headers={"Authorization": f"Bearer {API_KEY}"}, timeout=30,
+                                           rate_limit="stability")
         resp.raise_for_status()
         return resp.json()
     except Exception as e:
         print(f"Warning: Failed to list engines: {e}")
         return []
 
-def choose_engine(engines):
-    """Choose the best available engine, preferring SDXL."""
+def list_engines(refresh=False):
+    """List available engines, cached in memory and on disk for ENGINE_CACHE_TTL seconds."""
+    with _engines_lock:
+        now = time.time()
+        if not refresh:
+            if _engines_cache["engines"] and now - _engines_cache["fetched"] < ENGINE_CACHE_TTL:
+                return _engines_cache["engines"]
+
+            cached = fileutil.read_json(ENGINE_CACHE_PATH)
+            if cached and cached.get("engines") and now - cached.get("fetched", 0) < ENGINE_CACHE_TTL:
+                _engines_cache.update(cached)
+                return cached["engines"]
+
+        engines = fetch_engines()
+        # Failed lookups are not cached so the next call tries again
+        if engines:
+            _engines_cache.update(engines=engines, fetched=now)
+            try:
+                fileutil.atomic_write_json(ENGINE_CACHE_PATH, _engines_cache)
+            except OSError as e:
+                print(f"Warning: Failed to cache engine list: {e}")
+        return engines
+
+def choose_engine(engines, exclude=(), fast=False):
+    """Choose the best available engine, preferring SDXL.
+
+    fast=True prefers the cheaper, faster SD 1.x engines instead (used as a fallback);
+    engines whose id is in exclude are never chosen.
+    """
     if isinstance(engines, dict) and "engines" in engines:
         engines_list = engines["engines"]
     elif isinstance(engines, list):
         engines_list = engines
     else:
         engines_list = []
+    engines_list = [e for e in engines_list if e.get("id") not in exclude]
 
     if not engines_list:
         return None
 
+    if fast:
+        sd = [e for e in engines_list if "stable-diffusion" in e.get("id", "").lower()
+              and "xl" not in e.get("id", "").lower()]
+        if sd:
+            # Newest SD 1.x first (e.g. v1-6 before v1-5)
+            return max(sd, key=lambda e: e.get("id", ""))
+
     # Prefer 'sdxl' or 'stable-diffusion-xl'
     sdxl = next((e for e in engines_list if "sdxl" in (e.get("id", "").lower())), None)
     if sdxl:
@@ -119,8 +202,92 @@ def choose_engine(engines):
         
     return engines_list[0] if engines_list else None
 
-def generate_image(engine_id, prompt, output_path):
-    """Generate an image using the text-to-image API and save it."""
+def book_deadline(started=None):
+    """time.time() by which a book started at `started` must have its illustrations (None without a budget)"""
+    if BOOK_DEADLINE <= 0:
+        return None
+    return (started or time.time()) + BOOK_DEADLINE
+
+def hedge_delay():
+    """Seconds to wait for a generation before sending a duplicate request"""
+    with _health_lock:
+        samples = sorted(_latencies)
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DELAY
+    return samples[min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE / 100))]
+
+def record_engine_result(engine_id, ok):
+    with _health_lock:
+        if ok:
+            _engine_failures.pop(engine_id, None)
+        else:
+            failures, _ = _engine_failures.get(engine_id, (0, 0.0))
+            _engine_failures[engine_id] = (failures + 1, time.time())
+
+def engine_is_failing(engine_id):
+    with _health_lock:
+        failures, last = _engine_failures.get(engine_id, (0, 0.0))
+    return failures >= ENGINE_FALLBACK_AFTER and time.time() - last < ENGINE_FALLBACK_COOLDOWN
+
+def engine_for(engine_id, count=True):
+    """engine_id, or a faster engine from choose_engine while engine_id keeps failing
+
+    count=False leaves ENGINE_FALLBACKS alone, for lookups that don't generate anything.
+    """
+    if not engine_is_failing(engine_id):
+        return engine_id
+    with _health_lock:
+        known = list(_engine_failures)
+    failing = {engine_id} | {e for e in known if engine_is_failing(e)}
+    fallback = choose_engine(list_engines(), exclude=failing, fast=True)
+    if not fallback:
+        return engine_id
+    if count:
+        metrics.ENGINE_FALLBACKS.inc(engine=engine_id, fallback=fallback["id"])
+    return fallback["id"]
+
+def _get_request_executor():
+    global _request_executor
+    with _health_lock:
+        if _request_executor is None:
+            _request_executor = ThreadPoolExecutor(max_workers=HEDGE_POOL_SIZE, thread_name_prefix="generate")
+        return _request_executor
+
+@metrics.timed("generate_image")
+def generate_image_data(engine_id, prompt, deadline=None):
+    """Generate an image using the text-to-image API and return its PNG bytes (None on failure).
+
+    A request still running after hedge_delay() gets a duplicate and the first image
+    back wins; the slower request is left to finish and its result dropped.
+    Nothing is attempted past the deadline (a time.time() value).
+    """
+    if HEDGE_PERCENTILE <= 0:
+        return request_image_data(engine_id, prompt, deadline)
+
+    executor = _get_request_executor()
+    primary = executor.submit(request_image_data, engine_id, prompt, deadline)
+    delay = hedge_delay()
+    if deadline is not None:
+        delay = min(delay, max(0.0, deadline - time.time()))
+    try:
+        return primary.result(timeout=delay)
+    except TimeoutError:
+        pass
+
+    if deadline is not None and time.time() >= deadline:
+        return primary.result()
+    print(f"Generation slower than {delay:.1f}s, sending a hedged request...")
+    hedge = executor.submit(request_image_data, engine_id, prompt, deadline)
+    for future in as_completed([primary, hedge]):
+        data = future.result()
+        if data:
+            metrics.HEDGED_REQUESTS.inc(winner="hedge" if future is hedge else "primary")
+            return data
+    metrics.HEDGED_REQUESTS.inc(winner="none")
+    return None
+
+def request_image_data(engine_id, prompt, deadline=None):
+    """One text-to-image request (with HTTP retries). Returns PNG bytes or None."""
     url = f"{API_HOST}/v1/generation/{engine_id}/text-to-image"
     headers = {
         "Authorization": f"Bearer {API_KEY}",
@@ -129,42 +296,59 @@ def generate_image(engine_id, prompt, output_path):
     }
     payload = {
         "text_prompts": [{"text": prompt}],
-        "cfg_scale": 7,
+        "cfg_scale": CFG_SCALE,
         "height": HEIGHT,
         "width": WIDTH,
         "steps": STEPS,
-        "samples": SAMPLES
+        "samples": SAMPLES,
+        "seed": SEED
     }
 
     print(f"Generating image logic...")
+    started = time.time()
     try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=120)
+        if deadline is not None and started >= deadline:
+            print("Book deadline passed, not generating")
+            return None
+        ratelimit.acquire("stability_images", SAMPLES)
+        resp = http_client.request_with_retry("POST", url, headers=headers, json=payload, timeout=IMAGE_TIMEOUT,
+                                              rate_limit="stability", deadline=deadline)
         
         if resp.status_code != 200:
             print(f"Generation failed: {resp.status_code}")
+            record_engine_result(engine_id, False)
             try:
                 print(resp.json())
             except:
                 print(resp.text)
-            return False
+            return None
 
         data = resp.json()
         artifacts = data.get("artifacts", [])
         
         if not artifacts:
             print("No artifacts found in response.")
-            return False
+            record_engine_result(engine_id, False)
+            return None
 
-        # Save the first artifact
+        # Use the first artifact
         image_b64 = artifacts[0].get("base64")
         if image_b64:
-            with open(output_path, "wb") as f:
-                f.write(base64.b64decode(image_b64))
-            return True
-            
+            data = base64.b64decode(image_b64)
+            metrics.BYTES.inc(len(data), kind="image")
+            with _health_lock:
+                _latencies.append(time.time() - started)
+            record_engine_result(engine_id, True)
+            return data
+        record_engine_result(engine_id, False)
+        return None
+
     except Exception as e:
         print(f"An error occurred during generation: {str(e)}")
-        return False
+        # A request cut short by the book deadline is not the engine's fault
+        if deadline is None or time.time() < deadline:
+            record_engine_result(engine_id, False)
+        return None
 
 def build_prompt(page):
     """Construct a rich prompt from page details."""
@@ -203,8 +387,9 @@ def build_prompt(page):
     
     return prompt
 
+@lru_cache(maxsize=None)
 def get_font_paths():
-    """Resolve font path based on env, fonts dir, or fallback."""
+    """Resolve font path based on env, fonts dir, or fallback (resolved once per process)."""
     # 1. Check Env Var
     if CUSTOM_FONT_PATH and Path(CUSTOM_FONT_PATH).exists():
         return Path(CUSTOM_FONT_PATH)
@@ -218,152 +403,552 @@ def get_font_paths():
     # 3. Fallback (if no font found in folder or env)
     return None
 
-def add_text_to_image(img_path, page):
-    """Overlay title or story text onto the image."""
+@lru_cache(maxsize=None)
+def get_font(size):
+    """Process-wide font registry: each size is loaded from disk once."""
+    path = get_font_paths()
     try:
-        img = Image.open(img_path).convert("RGBA")
-        draw = ImageDraw.Draw(img, "RGBA")
-        
-        font_path = get_font_paths()
+        if path is None:
+            if FONTS_DIR.exists():
+                fonts = list(FONTS_DIR.glob("*.ttf")) + list(FONTS_DIR.glob("*.otf"))
+                if fonts:
+                    fonts.sort()
+                    path = fonts[0]
+                else:
+                    raise IOError("No .ttf or .otf fonts found in fonts folder")
+            else:
+                raise IOError("Fonts folder does not exist")
 
-        # Helper to load fonts with fallback
-        def load_fonts(path):
-            try:
-                if path is None:
-                    if FONTS_DIR.exists():
-                        fonts = list(FONTS_DIR.glob("*.ttf")) + list(FONTS_DIR.glob("*.otf"))
-                        if fonts:
-                            fonts.sort()
-                            path = fonts[0]
-                        else:
-                            raise IOError("No .ttf or .otf fonts found in fonts folder")
-                    else:
-                        raise IOError("Fonts folder does not exist")
-
-                return (ImageFont.truetype(str(path), 60),
-                        ImageFont.truetype(str(path), 36),
-                        ImageFont.truetype(str(path), 32))
-            except Exception as e:
-                d = ImageFont.load_default()
-                return d, d, d
+        return ImageFont.truetype(str(path), size)
+    except Exception:
+        return ImageFont.load_default()
 
-        font_title, font_story, font_moral = load_fonts(font_path)
+def load_fonts():
+    """Title, story and moral fonts"""
+    return get_font(TITLE_FONT_SIZE), get_font(STORY_FONT_SIZE), get_font(MORAL_FONT_SIZE)
 
-        # Helper: sample average background color in a bbox
-        def sample_avg_color(image, bbox):
-            try:
-                crop = image.crop(bbox).convert("RGB")
-                stat = ImageStat.Stat(crop)
-                r, g, b = [int(x) for x in stat.mean[:3]]
-                # Lighten the color by shifting toward white for a lighter shade
-                r = min(255, int(r * 0.5 + 255 * 0.5))
-                g = min(255, int(g * 0.5 + 255 * 0.5))
-                b = min(255, int(b * 0.5 + 255 * 0.5))
-                return (r, g, b)
-            except Exception:
-                return (250, 250, 250)
-
-        # Helper: choose text color (black/white) based on luminance
-        def choose_text_color(rgb):
-            r, g, b = rgb
-            luminance = (0.299*r + 0.587*g + 0.114*b)/255
-            return (0, 0, 0, 255) if luminance > 0.6 else (255, 255, 255, 255)
-
-        # Draw a rounded rect with alpha
-        def draw_box(x0, y0, x1, y1, fill):
-            draw.rounded_rectangle([x0, y0, x1, y1], radius=15, fill=fill)
-
-        # Decide layout
-        if page.get("type") == "title":
-            text = page.get("title", "")
-            font = font_title
-            wrap_width = 28
-            lines = textwrap.wrap(text, width=wrap_width)
-
-            # Compute text block size
-            padding = 20
-            line_heights = [draw.textbbox((0,0), l, font=font)[3] - draw.textbbox((0,0), l, font=font)[1] for l in lines]
-            text_h = sum(line_heights) + (len(lines)-1)*8
-            text_w = max([draw.textbbox((0,0), l, font=font)[2] for l in lines]) if lines else 0
-            box_w = min(img.width - 60, text_w + padding*2)
-            box_h = text_h + padding*2
-            box_x = (img.width - box_w)//2
-            box_y = 30
-
-            # Sample background under box to pick a harmonious color
-            sample_bbox = (max(0, box_x), max(0, box_y), min(img.width, box_x+box_w), min(img.height, box_y+box_h))
-            bg = sample_avg_color(img, sample_bbox)
-            text_color = choose_text_color(bg)
-            box_color = (bg[0], bg[1], bg[2], 220)
-
-            # Draw box and text
-            draw_box(box_x, box_y, box_x+box_w, box_y+box_h, box_color)
-            cur_y = box_y + padding
-            for line in lines:
-                bbox = draw.textbbox((0,0), line, font=font)
-                t_w = bbox[2] - bbox[0]
-                x = box_x + (box_w - t_w)//2
-                draw.text((x, cur_y), line, font=font, fill=text_color)
-                cur_y += (bbox[3] - bbox[1]) + 8
+@lru_cache(maxsize=4096)
+def measure_text(text, font):
+    """Bounding box (left, top, right, bottom) of a single line, memoized per font."""
+    return font.getbbox(text)
+
+def lighten(rgb):
+    """Lighten the color by shifting toward white for a lighter shade"""
+    return tuple(min(255, int(c * 0.5 + 255 * 0.5)) for c in rgb)
+
+def sample_avg_color(image, bbox):
+    """Sample average background color in a bbox"""
+    try:
+        crop = image.crop(bbox).convert("RGB")
+        stat = ImageStat.Stat(crop)
+        return lighten(int(x) for x in stat.mean[:3])
+    except Exception:
+        return (250, 250, 250)
+
+def _integral(values):
+    """Summed-area table with a leading row and column of zeros"""
+    table = np.zeros((values.shape[0] + 1, values.shape[1] + 1) + values.shape[2:], dtype=np.float64)
+    table[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+    return table
+
+class IntegralImage:
+    """Summed-area tables of a page, giving the mean color and luminance variance
+    of any box in O(1), so many candidate text positions can be scored cheaply."""
+
+    def __init__(self, img, scale=PLACEMENT_SCALE):
+        small = img.convert("RGB")
+        if scale > 1:
+            small = small.reduce(scale)
+        rgb = np.asarray(small, dtype=np.float64)
+        lum = rgb @ np.array([0.299, 0.587, 0.114])
+        self.scale = scale
+        self.width, self.height = small.size
+        self.rgb = _integral(rgb)
+        self.lum = _integral(lum)
+        self.lum_sq = _integral(lum * lum)
+
+    def _to_cells(self, x0, y0, x1, y1):
+        s = self.scale
+        return (np.clip(x0 // s, 0, self.width), np.clip(y0 // s, 0, self.height),
+                np.clip(-(-x1 // s), 0, self.width), np.clip(-(-y1 // s), 0, self.height))
+
+    @staticmethod
+    def _sums(table, x0, y0, x1, y1):
+        return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+    def mean_color(self, bbox):
+        """Average RGB inside bbox (full-page pixel coordinates)"""
+        x0, y0, x1, y1 = self._to_cells(*bbox)
+        area = max(1, (x1 - x0) * (y1 - y0))
+        return tuple(int(c) for c in self._sums(self.rgb, x0, y0, x1, y1) / area)
+
+    def best_position(self, box_w, box_h, x_range, y_range, default):
+        """Top-left corner within the given ranges whose box has the lowest luminance
+        spread, with a small pull toward the default position."""
+        xs = np.arange(x_range[0], max(x_range[0], x_range[1]) + 1, PLACEMENT_STEP)
+        ys = np.arange(y_range[0], max(y_range[0], y_range[1]) + 1, PLACEMENT_STEP)
+        gx, gy = np.meshgrid(xs, ys)
+        x0, y0, x1, y1 = self._to_cells(gx, gy, gx + box_w, gy + box_h)
+        area = np.maximum(1, (x1 - x0) * (y1 - y0))
+
+        mean = self._sums(self.lum, x0, y0, x1, y1) / area
+        var = self._sums(self.lum_sq, x0, y0, x1, y1) / area - mean * mean
+        distance = np.hypot(gx - default[0], gy - default[1])
+        score = np.sqrt(np.maximum(var, 0)) + PLACEMENT_DISTANCE_WEIGHT * distance
+
+        i = np.unravel_index(np.argmin(score), score.shape)
+        return int(gx[i]), int(gy[i])
+
+def place_box(img, integral, box_w, box_h, default, y_range):
+    """Position and lightened background color of a text box.
+
+    Without an integral image, or when the box is too tall for y_range, the box stays
+    at its default position.
+    """
+    if integral is None or y_range[1] < y_range[0]:
+        box_x, box_y = default
+        sample_bbox = (max(0, box_x), max(0, box_y), min(img.width, box_x+box_w), min(img.height, box_y+box_h))
+        return box_x, box_y, sample_avg_color(img, sample_bbox)
+
+    margin = 30
+    x_range = (margin, img.width - box_w - margin)
+    box_x, box_y = integral.best_position(box_w, box_h, x_range, y_range, default)
+    return box_x, box_y, lighten(integral.mean_color((box_x, box_y, box_x+box_w, box_y+box_h)))
+
+@metrics.timed("add_text")
+def render_text_overlay(img, page):
+    """Overlay title or story text onto an in-memory image and return the RGBA result."""
+    img = img.convert("RGBA")
+    draw = ImageDraw.Draw(img, "RGBA")
+    
+    font_title, font_story, font_moral = load_fonts()
+
+    # Built once per page, before anything is drawn
+    integral = IntegralImage(img) if TEXT_PLACEMENT == "auto" and np is not None else None
+
+    # Helper: choose text color (black/white) based on luminance
+    def choose_text_color(rgb):
+        r, g, b = rgb
+        luminance = (0.299*r + 0.587*g + 0.114*b)/255
+        return (0, 0, 0, 255) if luminance > 0.6 else (255, 255, 255, 255)
 
+    # Draw a rounded rect with alpha
+    def draw_box(x0, y0, x1, y1, fill):
+        draw.rounded_rectangle([x0, y0, x1, y1], radius=15, fill=fill)
+
+    # Decide layout
+    if page.get("type") == "title":
+        text = page.get("title", "")
+        font = font_title
+        wrap_width = 28
+        lines = textwrap.wrap(text, width=wrap_width)
+
+        # Compute text block size, measuring each line once
+        padding = 20
+        bboxes = [measure_text(l, font) for l in lines]
+        text_h = sum(b[3] - b[1] for b in bboxes) + (len(lines)-1)*8
+        text_w = max(b[2] for b in bboxes) if bboxes else 0
+        box_w = min(img.width - 60, text_w + padding*2)
+        box_h = text_h + padding*2
+        default = ((img.width - box_w)//2, 30)
+
+        # Find a calm spot in the upper half and sample its background to pick a harmonious color
+        box_x, box_y, bg = place_box(img, integral, box_w, box_h, default, (30, img.height//2 - box_h))
+        text_color = choose_text_color(bg)
+        box_color = (bg[0], bg[1], bg[2], 220)
+
+        # Draw box and text
+        draw_box(box_x, box_y, box_x+box_w, box_y+box_h, box_color)
+        cur_y = box_y + padding
+        for line, bbox in zip(lines, bboxes):
+            t_w = bbox[2] - bbox[0]
+            x = box_x + (box_w - t_w)//2
+            draw.text((x, cur_y), line, font=font, fill=text_color)
+            cur_y += (bbox[3] - bbox[1]) + 8
+
+    else:
+        text = page.get("text", "")
+        moral = page.get("moral")
+        font = font_story
+        wrap_width = 40
+        lines = textwrap.wrap(text, width=wrap_width)
+        if moral:
+            moral_lines = textwrap.wrap(f"Moral: {moral}", width=wrap_width)
         else:
-            text = page.get("text", "")
-            moral = page.get("moral")
-            font = font_story
-            wrap_width = 40
-            lines = textwrap.wrap(text, width=wrap_width)
-            if moral:
-                moral_lines = textwrap.wrap(f"Moral: {moral}", width=wrap_width)
-            else:
-                moral_lines = []
-
-            # Compute text block size
-            padding = 20
-            all_lines = lines + ([] if not moral_lines else [""] + moral_lines)
-            line_heights = [draw.textbbox((0,0), l, font=font)[3] - draw.textbbox((0,0), l, font=font)[1] for l in all_lines]
-            text_h = sum(line_heights) + (len(all_lines)-1)*8
-            text_w = max([draw.textbbox((0,0), l, font=font)[2] for l in all_lines]) if all_lines else 0
-            box_w = min(img.width - 60, text_w + padding*2)
-            box_h = text_h + padding*2
-            box_x = (img.width - box_w)//2
-            box_y = img.height - box_h - 30
-
-            # Sample background under box to pick a harmonious color
-            sample_bbox = (max(0, box_x), max(0, box_y), min(img.width, box_x+box_w), min(img.height, box_y+box_h))
-            bg = sample_avg_color(img, sample_bbox)
-            text_color = choose_text_color(bg)
-            box_color = (bg[0], bg[1], bg[2], 220)
-
-            # Draw box and text
-            draw_box(box_x, box_y, box_x+box_w, box_y+box_h, box_color)
-            cur_y = box_y + padding
-            for i, line in enumerate(lines):
-                bbox = draw.textbbox((0,0), line, font=font)
+            moral_lines = []
+
+        # Compute text block size
+        padding = 20
+        all_lines = lines + ([] if not moral_lines else [""] + moral_lines)
+        bboxes = [measure_text(l, font) for l in all_lines]
+        text_h = sum(b[3] - b[1] for b in bboxes) + (len(all_lines)-1)*8
+        text_w = max(b[2] for b in bboxes) if bboxes else 0
+        box_w = min(img.width - 60, text_w + padding*2)
+        box_h = text_h + padding*2
+        default = ((img.width - box_w)//2, img.height - box_h - 30)
+
+        # Find a calm spot in the lower half and sample its background to pick a harmonious color
+        box_x, box_y, bg = place_box(img, integral, box_w, box_h, default, (img.height//2, img.height - box_h - 30))
+        text_color = choose_text_color(bg)
+        box_color = (bg[0], bg[1], bg[2], 220)
+
+        # Draw box and text
+        draw_box(box_x, box_y, box_x+box_w, box_y+box_h, box_color)
+        cur_y = box_y + padding
+        for line, bbox in zip(lines, bboxes):
+            t_w = bbox[2] - bbox[0]
+            x = box_x + (box_w - t_w)//2
+            draw.text((x, cur_y), line, font=font, fill=text_color)
+            cur_y += (bbox[3] - bbox[1]) + 8
+
+        if moral_lines:
+            # Add a small separator line
+            cur_y += 6
+            for line in moral_lines:
+                bbox = measure_text(line, font_moral)
                 t_w = bbox[2] - bbox[0]
                 x = box_x + (box_w - t_w)//2
-                draw.text((x, cur_y), line, font=font, fill=text_color)
-                cur_y += (bbox[3] - bbox[1]) + 8
-
-            if moral_lines:
-                # Add a small separator line
-                cur_y += 6
-                for line in moral_lines:
-                    bbox = draw.textbbox((0,0), line, font=font_moral)
-                    t_w = bbox[2] - bbox[0]
-                    x = box_x + (box_w - t_w)//2
-                    draw.text((x, cur_y), line, font=font_moral, fill=text_color)
-                    cur_y += (bbox[3] - bbox[1]) + 6
+                draw.text((x, cur_y), line, font=font_moral, fill=text_color)
+                cur_y += (bbox[3] - bbox[1]) + 6
+
+    return img
 
+def add_text_to_image(img_path, page):
+    """Overlay title or story text onto the image."""
+    try:
+        img = render_text_overlay(Image.open(img_path), page)
         # Save back to same path
-        img.save(img_path)
+        img.save(img_path, "PNG", compress_level=PAGE_PNG_COMPRESS_LEVEL)
         print(f"Added text to {img_path.name}")
     except Exception as e:
         print(f"Failed to add text to image: {e}")
 
-def main():
-    setup_environment()
+def base_path(base_dir, prompt):
+    """Where a job keeps the clean base image drawn for a prompt"""
+    return Path(base_dir) / f"{hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:24]}.png"
 
-    # 1. Select Engine
+def load_base(base_dir, prompt):
+    """Clean base image bytes a job kept for this prompt, or None"""
+    try:
+        return base_path(base_dir, prompt).read_bytes()
+    except OSError:
+        return None
+
+def base_engine(base_dir, prompt):
+    """Engine that drew the base image a job kept for this prompt, or None"""
+    try:
+        return json.loads(base_path(base_dir, prompt).with_suffix(".json").read_text())["engine_id"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def store_base(base_dir, prompt, data, engine_id):
+    """Keep a page's clean base image, with the engine that drew it next to it"""
+    path = base_path(base_dir, prompt)
+    try:
+        fileutil.atomic_write_json(path.with_suffix(".json"), {"engine_id": engine_id})
+        fileutil.atomic_write_bytes(path, data)
+    except OSError as e:
+        print(f"Warning: Failed to keep base image: {e}")
+
+def image_key(engine_id, prompt):
+    """Image cache key for a prompt drawn by engine_id with this module's settings"""
+    return image_cache.cache_key(engine_id, prompt, WIDTH, HEIGHT, STEPS, CFG_SCALE, SEED)
+
+def fetch_base_data(engine_id, key, page, deadline=None, base_dir=None):
+    """Get the clean (text-free) PNG bytes for a page, from the cache or the API. Returns None on failure.
+
+    A failed generation is tried again (PAGE_ATTEMPTS in all), on a fallback engine
+    once engine_id has failed ENGINE_FALLBACK_AFTER times in a row. With base_dir
+    (a job's bases folder) the base is kept there and reused before the shared cache.
+    """
+    print(f"\nProcessing {key}...")
+
+    # Build prompt
+    prompt = build_prompt(page)
+
+    if base_dir is not None:
+        data = load_base(base_dir, prompt)
+        if data:
+            print(f"Using this book's base image for {key}")
+            return data
+
+    # Reuse a clean base image generated earlier for the exact same request, by the
+    # engine that drew this page before or by the fallback currently in use
+    engines = [engine_id]
+    for engine in (base_engine(base_dir, prompt) if base_dir is not None else None,
+                   engine_for(engine_id, count=False)):
+        if engine and engine not in engines:
+            engines.append(engine)
+    for engine in engines:
+        data = image_cache.load(image_key(engine, prompt))
+        if data:
+            print(f"Using cached image for {key}")
+            if base_dir is not None:
+                store_base(base_dir, prompt, data, engine)
+            return data
+
+    for attempt in range(PAGE_ATTEMPTS):
+        if deadline is not None and time.time() >= deadline:
+            print(f"Book deadline passed, giving up on {key}")
+            break
+        engine = engine_for(engine_id)
+        if engine != engine_id:
+            print(f"{engine_id} keeps failing, using {engine} for {key}")
+        data = generate_image_data(engine, prompt, deadline)
+        if data:
+            print(f"Generated image for {key}")
+            # Cache the clean base before the text goes on, under the engine that drew it
+            image_cache.store(image_key(engine, prompt), data)
+            if base_dir is not None:
+                store_base(base_dir, prompt, data, engine)
+            return data
+
+    print(f"Failed to generate image for {key}")
+    return None
+
+def fetch_base_image(engine_id, key, page, out_dir=OUT_DIR, deadline=None, base_dir=None):
+    """Write the clean base image for a page to out_dir. Returns the path or None."""
+    data = fetch_base_data(engine_id, key, page, deadline, base_dir)
+    if not data:
+        return None
+    output_file = out_dir / f"{key}.png"
+    fileutil.atomic_write_bytes(output_file, data)
+    return output_file
+
+def save_preview(img, out_dir, key):
+    """Write a downscaled preview of a finished page. Returns its path."""
+    preview = img.convert("RGB")
+    preview.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE), Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    options = {"quality": PREVIEW_QUALITY}
+    if PREVIEW_FORMAT.lower() == "webp":
+        options.update(lossless=PREVIEW_LOSSLESS, method=PREVIEW_WEBP_METHOD)
+    preview.save(buf, PREVIEW_FORMAT.upper(), **options)
+    output_file = out_dir / f"{key}.{PREVIEW_FORMAT.lower()}"
+    fileutil.atomic_write_bytes(output_file, buf.getvalue())
+    return output_file
+
+def overlay_page(base, key, page, out_dir=None):
+    """Overlay a page's text on its decoded base image, optionally saving the PNG."""
+    try:
+        img = render_text_overlay(base, page)
+    except Exception as e:
+        print(f"Failed to add text to {key}: {e}")
+        img = base.convert("RGBA")
+    if out_dir is not None:
+        img.save(out_dir / f"{key}.png", "PNG", compress_level=PAGE_PNG_COMPRESS_LEVEL)
+    return img
+
+def finish_page(data, key, page, out_dir=None, pdf_profile=None, preview_dir=None):
+    """CPU stage of a page: overlay its text on the base image bytes and encode the results
+
+    Runs in a render_pool worker, so it only takes and returns picklable values.
+    The page PNG goes to out_dir and a preview to preview_dir when given. Returns
+    {"key", "size", "pdf": encode_page tuple for pdf_profile or None}.
+    """
+    import pdf_generator
+
+    img = overlay_page(Image.open(io.BytesIO(data)), key, page, out_dir)
+    if preview_dir is not None:
+        try:
+            save_preview(img, preview_dir, key)
+        except Exception as e:
+            print(f"Warning: Failed to save preview for {key}: {e}")
+    encoded = pdf_generator.encode_page(img, pdf_profile) if pdf_profile else None
+    return {"key": key, "size": img.size, "pdf": encoded}
+
+def render_page(engine_id, key, page, out_dir=None, deadline=None, base_dir=None, prepare=None):
+    """Generate a page and overlay its text entirely in memory. Returns a PIL image or None.
+
+    The PNG is only written when out_dir is given. With prepare (finish_page keyword
+    arguments) the CPU work runs in the render pool and finish_page's dict is returned.
+    """
+    data = fetch_base_data(engine_id, key, page, deadline, base_dir)
+    if not data:
+        return None
+    if prepare is not None:
+        return render_pool.submit(finish_page, data, key, page, out_dir, **prepare).result()
+    return overlay_page(Image.open(io.BytesIO(data)), key, page, out_dir)
+
+def process_page(engine_id, key, page, out_dir=OUT_DIR, deadline=None, base_dir=None):
+    """Generate the image for one page and overlay its text. Returns the output path or None."""
+    output_file = fetch_base_image(engine_id, key, page, out_dir, deadline, base_dir)
+    if output_file:
+        # Overlay Text as soon as this page's image has arrived
+        add_text_to_image(output_file, page)
+    return output_file
+
+def generate_pages(engine_id, story_data, page_keys, workers=None, out_dir=OUT_DIR, on_page=None, in_memory=False,
+                   keep_images=True, deadline=None, prepare=None, base_dir=None):
+    """Generate all pages, up to `workers` at a time. Returns {key: path or None} in page order.
+
+    With in_memory=True the values are PIL images instead, and PNGs are only written
+    if out_dir is not None. If given, on_page(key, result) is called as each page finishes.
+    keep_images=False keeps only a True/None flag per page once on_page has seen it,
+    so a consumer such as PdfWriter can let each bitmap go as soon as it is written.
+    Pages not generated by the deadline (a time.time() value, see book_deadline) fail.
+    prepare (in_memory only) hands the overlay and encoding to the render pool, see render_page.
+    base_dir keeps each page's clean base image, see fetch_base_data.
+    """
+    task = partial(render_page, prepare=prepare) if in_memory else process_page
+    if workers is None:
+        workers = IMAGE_WORKERS
+    workers = max(1, min(workers, len(page_keys) or 1))
+
+    results = {}
+
+    def report(key, result):
+        if on_page:
+            try:
+                on_page(key, result)
+            except Exception as e:
+                print(f"Warning: page callback failed for {key}: {e}")
+        results[key] = result if keep_images else (True if result else None)
+
+    if workers == 1:
+        for key in page_keys:
+            report(key, task(engine_id, key, story_data[key], out_dir, deadline, base_dir))
+        return results
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="page") as executor:
+        futures = {
+            executor.submit(task, engine_id, key, story_data[key], out_dir, deadline, base_dir): key
+            for key in page_keys
+        }
+        for future in as_completed(futures):
+            key = futures.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Failed to process {key}: {e}")
+                result = None
+            report(key, result)
+            result = None
+
+    # Report in page order regardless of completion order
+    return {key: results.get(key) for key in page_keys}
+
+class StreamingPageRenderer:
+    """Starts page illustrations while the story is still being written
+
+    submit() kicks off the base image for a page as soon as its scene is known;
+    finish() overlays the final text (including the moral, which only arrives at the
+    end) on each page as its image lands. With in_memory=True pages stay PIL images
+    and PNGs are only written if out_dir is not None. Illustrations not finished by
+    the deadline (see book_deadline) fail. base_dir keeps the clean base images of
+    the book (see fetch_base_data).
+    """
+
+    def __init__(self, engine_id, out_dir=OUT_DIR, workers=None, in_memory=False, deadline=None, base_dir=None):
+        self.engine_id = engine_id
+        self.deadline = deadline
+        self.base_dir = base_dir
+        self.out_dir = out_dir
+        self.in_memory = in_memory
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers or IMAGE_WORKERS), thread_name_prefix="page")
+        # Keyed by prompt, so pages renumbered after a story repair still find their image
+        self._futures = {}
+        # Illustrations for prompts the final story no longer has, still running
+        self._orphans = set()
+
+    def submit(self, key, page):
+        """Start generating the base image for a page"""
+        prompt = build_prompt(page)
+        if prompt not in self._futures:
+            self._futures[prompt] = self._executor.submit(fetch_base_data, self.engine_id, key, page,
+                                                         self.deadline, self.base_dir)
+
+    def finish(self, story_data, on_page=None, keep_images=True, prepare=None):
+        """Overlay text once images arrive. Returns {key: path/image or None} in page order.
+
+        See generate_pages for keep_images. With prepare (finish_page keyword arguments,
+        in_memory only) the overlay and encoding of each page run in the render pool as
+        its image lands, and results are finish_page dicts.
+        """
+        page_keys = sorted((k for k in story_data if k.startswith("page_")), key=lambda x: int(x.split('_')[1]))
+
+        # Pages the stream never announced (or that changed since) are generated now
+        waiting = {}
+        for key in page_keys:
+            self.submit(key, story_data[key])
+            waiting.setdefault(self._futures[build_prompt(story_data[key])], []).append(key)
+
+        # A repair can change every prompt (e.g. a filled-in character description): drop the
+        # illustrations nobody waits for that haven't started, and don't wait for the rest
+        for future in self._futures.values():
+            if future not in waiting and not future.cancel():
+                self._orphans.add(future)
+
+        results = {}
+
+        def report(key, result):
+            if on_page:
+                try:
+                    on_page(key, result)
+                except Exception as e:
+                    print(f"Warning: page callback failed for {key}: {e}")
+            results[key] = result if keep_images else (True if result else None)
+
+        # Base images and render pool pages finish in any order; each page is reported once its CPU work is done
+        preparing = {}
+        pending = set(waiting)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in preparing:
+                    key = preparing.pop(future)
+                    try:
+                        report(key, future.result())
+                    except Exception as e:
+                        print(f"Failed to process {key}: {e}")
+                        report(key, None)
+                    continue
+
+                try:
+                    data = future.result()
+                except Exception as e:
+                    print(f"Failed to generate image: {e}")
+                    data = None
+                for key in waiting.pop(future):
+                    if data and prepare is not None and self.in_memory:
+                        page_future = render_pool.submit(finish_page, data, key, story_data[key], self.out_dir,
+                                                         **prepare)
+                        preparing[page_future] = key
+                        pending.add(page_future)
+                        continue
+                    try:
+                        result = self._overlay(data, key, story_data[key]) if data else None
+                    except Exception as e:
+                        print(f"Failed to process {key}: {e}")
+                        result = None
+                    report(key, result)
+                    result = None
+
+        self._futures.clear()
+        return {key: results.get(key) for key in page_keys}
+
+    def _overlay(self, data, key, page):
+        if self.in_memory:
+            return overlay_page(Image.open(io.BytesIO(data)), key, page, self.out_dir)
+        output_file = self.out_dir / f"{key}.png"
+        fileutil.atomic_write_bytes(output_file, data)
+        add_text_to_image(output_file, page)
+        return output_file
+
+    def close(self, cancel=False):
+        # Orphaned illustrations (see finish) run out in the background
+        running = any(not future.done() for future in self._orphans)
+        self._executor.shutdown(wait=not running, cancel_futures=cancel)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Don't start illustrations for a story that failed
+        self.close(cancel=exc_type is not None)
+
+def get_engine_id():
+    """Pick the engine to generate with (the engine list is cached, see list_engines)"""
     print("Fetching available engines...")
     engines = list_engines()
     chosen_engine = choose_engine(engines)
@@ -371,15 +956,22 @@ def main():
     # Use a default if API listing fails, assuming user has access
     engine_id = chosen_engine.get("id") if chosen_engine else "stable-diffusion-xl-1024-v1-0"
     print(f"Using engine: {engine_id}")
+    return engine_id
+
+def main(workers=None, job_id=None, on_page=None, in_memory=False, keep_images=True):
+    """Generate every page of the story. See generate_pages for in_memory."""
+    setup_environment(job_id)
+
+    # 1. Select Engine
+    engine_id = get_engine_id()
 
     # 2. Load Story - Find the latest story automatically
-    story_path = get_latest_story_path()
+    story_path = get_latest_story_path(job_id)
     if not story_path:
-        print("Could not find any story to process.")
-        sys.exit(1)
+        raise PipelineError("Could not find any story to process.")
         
-    with open(story_path, "r", encoding="utf-8") as f:
-        story_data = json.load(f)
+    # Accepts both the compact and the legacy story.json
+    story_data = load_story(story_path)
 
     # 3. Iterate and Generate
     print("Starting image generation...")
@@ -392,70 +984,32 @@ def main():
     except:
         page_keys.sort() # Fallback
 
-    images_generated = False
-    for key in page_keys:
-        print(f"\nProcessing {key}...")
-        page = story_data[key]
-        
-        # Build prompt
-        prompt = build_prompt(page)
-        
-        # Define output path
-        output_file = OUT_DIR / f"{key}.png"
-        archived_base = BASE_DIR / "output" / "prev_img_dataset" / f"{key}.png"
-        
-        # Generate Image Run every time as per automation request, or we can skip strictly if desired, but user probably wants fresh run)
-        # If an output already exists, try to avoid overlaying text on top of previous text.
-        if output_file.exists():
-             # If we have a clean base image in archive, restore it and apply text
-             if archived_base.exists():
-                 try:
-                     from shutil import copy2
-                     copy2(str(archived_base), str(output_file))
-                     print(f"Restored clean base image for {key} from archive. Re-applying text...")
-                     add_text_to_image(output_file, page)
-                     images_generated = True
-                     continue
-                 except Exception as e:
-                     print(f"Warning: Failed to restore archived base image: {e}")
-
-             # No clean base available — remove and regenerate to avoid stacking text
-             try:
-                 output_file.unlink()
-                 print(f"Removed existing image {output_file.name} to regenerate cleanly.")
-             except Exception:
-                 pass
-
-        success = generate_image(engine_id, prompt, output_file)
-        
-        if success:
-            print(f"Generated image at {output_file}")
-            # Overlay Text
-            add_text_to_image(output_file, page)
-            images_generated = True
-        else:
-            print(f"Failed to generate image for {key}")
+    out_dir = workspace.get_images_dir(job_id)
+    if in_memory and not SAVE_PAGE_IMAGES:
+        out_dir = None
+    results = generate_pages(engine_id, story_data, page_keys, workers=workers, out_dir=out_dir,
+                             on_page=on_page, in_memory=in_memory, keep_images=keep_images)
+    for key, result in results.items():
+        print(f"{key}: {'ok' if result else 'FAILED'}")
+    images_generated = any(results.values())
 
     print("\nImage generation complete!")
     
-    # 4. Automate PDF Generation
-    if images_generated:
-        print("\nStarting PDF generation...")
-        pdf_script = BASE_DIR / "pdf_generstor.py"
-        try:
-            # Check if pdf script exists
-            if not pdf_script.exists():
-                 print(f"Error: PDF generator script not found at {pdf_script}")
-            else:
-                subprocess.run([sys.executable, str(pdf_script)], check=True)
-                print("PDF generation finished.")
-                # After PDF generation (and image archiving inside pdf_generstor), archive JSON story files
-                print("\nArchiving story JSON files...")
-                archive_story(story_path)
-        except subprocess.CalledProcessError as e:
-            print(f"Error running PDF generator: {e}")
-    else:
-        print("No images were generated or found, skipping PDF generation.")
+    # Job workspaces (and in-memory runs) are assembled into a PDF by the caller
+    if job_id is not None or in_memory:
+        return results
+
+    # 4. PDF Generation, in this process
+    if not images_generated:
+        raise PipelineError("No images were generated or found, skipping PDF generation.")
+    print("\nStarting PDF generation...")
+    import pdf_generator
+    pdf_path = pdf_generator.main(archive_images=False)
+    print("PDF generation finished.")
+    # Then file story, images and PDF away as one book
+    print("\nArchiving story and images...")
+    archive.archive_files(story_path=story_path, images_dir=workspace.get_images_dir(), pdf_path=pdf_path)
+    return results
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,152 @@
+import os
+import queue
+import threading
+import time
+
+import fileutil
+import metrics
+import workspace
+from pipeline import get_pipeline
+
+# Number of storybooks generated at the same time
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Jobs allowed to wait for a free worker before /generate answers 429
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "20"))
+# Fallback Retry-After (seconds) when no job has finished yet
+JOB_RETRY_AFTER = int(os.getenv("JOB_RETRY_AFTER", "60"))
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue has no room for another job"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Job queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+def run_job(job_id, gist, update, fresh=False, stream=None, profile=None):
+    """Run the full pipeline for one job, reporting progress through update(**fields)"""
+    return get_pipeline().run(gist, job_id=job_id, fresh=fresh, profile=profile, stream=stream, update=update)
+
+
+class JobQueue:
+    """Bounded queue of storybook jobs served by a pool of worker threads"""
+
+    def __init__(self, workers=JOB_WORKERS, max_pending=JOB_QUEUE_SIZE, runner=run_job):
+        self.workers = max(1, workers)
+        self.runner = runner
+        self._queue = queue.Queue(maxsize=max(1, max_pending))
+        self._statuses = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._durations = []
+
+    def start(self):
+        """Start the worker threads (once)"""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, gist, job_id=None, **options):
+        """Queue a job and return its ID right away. Options are passed on to the runner."""
+        self.start()
+        new_workspace = job_id is None
+        job_id = workspace.create_workspace(job_id)
+        now = time.time()
+        status = {
+            "job_id": job_id,
+            "state": "queued",
+            "stage": "queued",
+            "pages_total": 0,
+            "pages_done": 0,
+            "pages": {},
+            "pages_failed": [],
+            "error": None,
+            "created": now,
+            "updated": now,
+        }
+        with self._lock:
+            self._statuses[job_id] = status
+        try:
+            self._queue.put_nowait((job_id, gist, options))
+        except queue.Full:
+            with self._lock:
+                del self._statuses[job_id]
+            # Don't leave an empty folder behind for every rejected request
+            if new_workspace:
+                workspace.remove_workspace(job_id)
+            raise QueueFullError(self.retry_after())
+        self._save(job_id)
+        return job_id
+
+    def get_status(self, job_id):
+        """Current status of a job, also found for jobs run by other processes"""
+        with self._lock:
+            status = self._statuses.get(job_id)
+            if status is not None:
+                return dict(status, pages=dict(status["pages"]))
+        if not workspace.is_valid_job_id(job_id):
+            return None
+        return fileutil.read_json(workspace.get_status_path(job_id))
+
+    def retry_after(self):
+        """Rough wait (seconds) until a queue slot frees up"""
+        with self._lock:
+            durations = list(self._durations)
+        if not durations:
+            return JOB_RETRY_AFTER
+        avg = sum(durations) / len(durations)
+        return max(1, int(avg / self.workers))
+
+    def _update(self, job_id, **fields):
+        page = fields.pop("page", None)
+        with self._lock:
+            status = self._statuses[job_id]
+            status.update(fields)
+            if page is not None:
+                key, state = page
+                status["pages"][key] = state
+                status["pages_done"] = len(status["pages"])
+            status["updated"] = time.time()
+        self._save(job_id)
+
+    def _save(self, job_id):
+        with self._lock:
+            status = dict(self._statuses[job_id])
+            status["pages"] = dict(status["pages"])
+        try:
+            fileutil.atomic_write_json(workspace.get_status_path(job_id), status)
+        except OSError as e:
+            print(f"Warning: Failed to save status for job {job_id}: {e}")
+
+    def _worker(self):
+        while True:
+            job_id, gist, options = self._queue.get()
+            started = time.time()
+            with self._lock:
+                queued = self._statuses[job_id]["created"]
+            metrics.STAGE_SECONDS.observe(started - queued, stage="queue_wait")
+            self._update(job_id, state="running")
+            state = "failed"
+            try:
+                result = self.runner(job_id, gist, lambda **fields: self._update(job_id, **fields), **options)
+                # A book can finish with a few pages missing; say which
+                pages_failed = (result or {}).get("pages_failed") or []
+                self._update(job_id, state="done", stage="done", pages_failed=pages_failed)
+                state = "done"
+            except Exception as e:
+                print(f"Job {job_id} failed: {e}")
+                self._update(job_id, state="failed", error=str(e) or type(e).__name__)
+            finally:
+                duration = time.time() - started
+                metrics.JOB_SECONDS.observe(duration, state=state)
+                metrics.JOBS.inc(state=state)
+                # Finished jobs are served from their status file from now on
+                with self._lock:
+                    self._durations = (self._durations + [duration])[-20:]
+                    self._statuses.pop(job_id, None)
+                self._queue.task_done()
@@ -0,0 +1,162 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Stage durations run from a few milliseconds (parsing) to minutes (a whole book)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_registry = []
+_registry_lock = threading.Lock()
+# Callbacks receiving every histogram observation, see add_listener
+_listeners = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class of a labelled metric kept in this process's registry"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """(suffix, label values, extra labels, value) tuples for the exposition format"""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing total"""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        if not name.endswith("_total"):
+            name += "_total"
+        super().__init__(name, documentation, labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [("", key, (), value) for key, value in items]
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+        for listener in list(_listeners):
+            listener(self.name, labels, value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a block (also usable as a decorator)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        samples = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", key, (("le", _format_value(float(bound))),), cumulative))
+            samples.append(("_count", key, (), cumulative))
+            samples.append(("_sum", key, (), total))
+        return samples
+
+
+def add_listener(callback):
+    """Also send every histogram observation to callback(name, labels, value), e.g. for exact percentiles"""
+    _listeners.append(callback)
+
+def remove_listener(callback):
+    try:
+        _listeners.remove(callback)
+    except ValueError:
+        pass
+
+def replay(observations):
+    """Record (name, labels, value) histogram observations made in another process"""
+    with _registry_lock:
+        histograms = {m.name: m for m in _registry if isinstance(m, Histogram)}
+    for name, labels, value in observations:
+        histograms[name].observe(value, **labels)
+
+def render():
+    """All metrics of this process in the Prometheus text exposition format"""
+    with _registry_lock:
+        metrics = list(_registry)
+    return "\n".join(m.render() for m in metrics) + "\n"
+
+
+# Pipeline metrics. They are per process: with several web workers each one
+# reports the jobs it ran itself.
+STAGE_SECONDS = Histogram("storybook_stage_seconds", "Time spent in each pipeline stage", ["stage"])
+JOB_SECONDS = Histogram("storybook_job_seconds", "Time from job start to finish", ["state"])
+JOBS = Counter("storybook_jobs", "Finished jobs by outcome", ["state"])
+BYTES = Counter("storybook_bytes", "Bytes produced by kind (image, pdf, story)", ["kind"])
+HTTP_REQUESTS = Counter("storybook_http_requests", "HTTP attempts by host and status", ["host", "status"])
+HTTP_RETRIES = Counter("storybook_http_retries", "Retried HTTP attempts by host and reason", ["host", "reason"])
+CACHE_REQUESTS = Counter("storybook_cache_requests", "Cache lookups by cache and result", ["cache", "result"])
+RATE_LIMIT_WAIT = Counter("storybook_rate_limit_wait_seconds", "Time spent waiting for rate limit budgets",
+                          ["budget"])
+HEDGED_REQUESTS = Counter("storybook_hedged_requests", "Duplicate image requests by which attempt answered first",
+                          ["winner"])
+ENGINE_FALLBACKS = Counter("storybook_engine_fallbacks", "Image generations sent to a fallback engine",
+                           ["engine", "fallback"])
+
+def timed(stage):
+    """Time a block or function as a pipeline stage"""
+    return STAGE_SECONDS.time(stage=stage)
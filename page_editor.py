@@ -0,0 +1,121 @@
+import io
+import time
+
+from filelock import FileLock
+from PIL import Image
+
+import archive
+import fileutil
+import image_cache
+import workspace
+from split_pages import load_story, split_pages, story_from_pages
+
+# Fields that can be edited on each kind of page
+EDITABLE_FIELDS = {
+    "title": ("title", "story_overview"),
+    "story": ("text", "scene", "moral"),
+}
+
+
+class EditError(Exception):
+    """Raised when an edit cannot be applied"""
+
+
+def base_image_data(job_id, engine_id, key, page, new_picture):
+    """Clean base image of a page and whether it was drawn anew
+
+    The book's own copy is used (or, for books rendered before those were kept, the
+    image cache). Only a changed picture (new_picture) is ever generated, so a text
+    edit never replaces the illustration.
+    """
+    import image_generator
+    prompt = image_generator.build_prompt(page)
+    bases_dir = workspace.get_bases_dir(job_id)
+    data = image_generator.load_base(bases_dir, prompt)
+    if data:
+        return data, False
+    # Look the cache up under the engine that drew this page, which may have been a fallback
+    drawn_by = image_generator.base_engine(bases_dir, prompt) or engine_id
+    data = image_cache.load(image_generator.image_key(drawn_by, prompt))
+    if data:
+        image_generator.store_base(bases_dir, prompt, data, drawn_by)
+        return data, False
+    if not new_picture:
+        raise EditError("The picture of this page is no longer available; edit its scene to draw a new one")
+    return image_generator.fetch_base_data(engine_id, key, page, base_dir=bases_dir), True
+
+def edit_page(job_id, page_number, changes):
+    """Update one page of a finished storybook and re-render only that page
+
+    Text, title and moral edits re-apply the overlay on the book's clean base image;
+    scene (or title-page overview) edits generate just that page's illustration again.
+    The PDF is reassembled from the stored encoded pages, so other pages are not
+    re-encoded. Returns a summary dict.
+    """
+    # Imported here so the web process only loads the API clients when a page is edited
+    import image_generator
+    import pdf_generator
+
+    started = time.time()
+    if not workspace.is_valid_job_id(job_id):
+        raise EditError("Unknown job ID")
+
+    status = fileutil.read_json(workspace.get_status_path(job_id))
+    if not status:
+        raise EditError("Unknown job ID")
+    story_path = workspace.get_stories_dir(job_id) / "story.json"
+    settings = fileutil.read_json(workspace.get_render_settings_path(job_id))
+    page_store = workspace.get_pdf_pages_dir(job_id)
+    if status.get("state") != "done" or not story_path.exists() or not settings or not page_store.exists():
+        raise EditError("This storybook is not finished yet")
+
+    with FileLock(str(workspace.get_job_dir(job_id) / "edit.lock")):
+        pages = load_story(story_path)
+        key = f"page_{page_number}"
+        if key not in pages:
+            raise EditError(f"Page {page_number} does not exist")
+
+        page = dict(pages[key])
+        allowed = EDITABLE_FIELDS.get(page.get("type"), ())
+        changes = {k: str(v).strip() for k, v in changes.items() if v is not None}
+        unknown = set(changes) - set(allowed)
+        if unknown:
+            raise EditError(f"Cannot edit {', '.join(sorted(unknown))} on this page")
+        if "moral" in changes and page_number != len(pages):
+            raise EditError("The moral is on the last page")
+        changes = {k: v for k, v in changes.items() if page.get(k, "") != v}
+        if not changes:
+            return {"job_id": job_id, "page": page_number, "changed": [], "regenerated": False,
+                    "seconds": round(time.time() - started, 3)}
+
+        old_prompt = image_generator.build_prompt(page)
+        page.update(changes)
+        pages[key] = page
+
+        # Get the clean base: same prompt -> the book's copy, new prompt -> one new illustration
+        engine_id = settings["engine_id"]
+        data, regenerated = base_image_data(job_id, engine_id, key, page,
+                                            image_generator.build_prompt(page) != old_prompt)
+        if not data:
+            raise EditError(f"Could not generate an image for page {page_number}")
+
+        images_dir = workspace.get_images_dir(job_id)
+        save_png = image_generator.SAVE_PAGE_IMAGES or (images_dir / f"{key}.png").exists()
+        image = image_generator.overlay_page(Image.open(io.BytesIO(data)), key, page,
+                                             images_dir if save_png else None)
+        image_generator.save_preview(image, workspace.get_previews_dir(job_id), key)
+
+        pdf_generator.rebuild_pdf(workspace.get_pdf_path(job_id), page_store, settings.get("profile"),
+                                  replace={page_number: image})
+
+        # Save the story last, once the new page is in the PDF
+        split_pages(story_from_pages(pages), job_id=job_id)
+        archive.archive_job(job_id)
+
+    return {
+        "job_id": job_id,
+        "page": page_number,
+        "changed": sorted(changes),
+        "regenerated": regenerated,
+        "seconds": round(time.time() - started, 3),
+    }
@@ -1,85 +1,327 @@
+import io
 import os 
-import shutil
 import sys 
 from pathlib import Path
 from PIL import Image 
 
+import archive
+import fileutil
+import metrics
+import render_pool
+import workspace
+
 BASE_DIR = Path(__file__).resolve().parent
 
-def img_to_pdf(images_folder, output_pdfName):
+# Pages are laid out at this many pixels (of the generated image) per inch
+PDF_RESOLUTION = 100.0
+
+# Extra JPEG pass for optimal Huffman tables: a few percent smaller pages for more CPU per page
+PDF_JPEG_OPTIMIZE = os.getenv("PDF_JPEG_OPTIMIZE", "1") != "0"
+
+# How pages are embedded. max_size caps the longer side of the embedded image
+# (None = full resolution); the printed page size stays the same either way.
+PDF_PROFILES = {
+    "web": {"max_size": 768, "quality": int(os.getenv("PDF_WEB_QUALITY", "70")), "subsampling": 2,
+            "optimize": PDF_JPEG_OPTIMIZE},
+    "print": {"max_size": None, "quality": int(os.getenv("PDF_PRINT_QUALITY", "95")), "subsampling": 0,
+              "optimize": PDF_JPEG_OPTIMIZE},
+    "thumbnail": {"max_size": 256, "quality": int(os.getenv("PDF_THUMBNAIL_QUALITY", "60")), "subsampling": 2,
+                  "optimize": PDF_JPEG_OPTIMIZE},
+}
+DEFAULT_PDF_PROFILE = os.getenv("PDF_PROFILE", "web")
+
+def get_profile(name=None):
+    """Settings of a PDF output profile (the default one if name is None)"""
+    name = name or DEFAULT_PDF_PROFILE
+    if name not in PDF_PROFILES:
+        raise ValueError(f"Unknown PDF profile {name!r}, expected one of {', '.join(PDF_PROFILES)}")
+    return PDF_PROFILES[name]
+
+@metrics.timed("pdf_encode")
+def encode_page(image, profile):
+    """Encode a page image for a profile (settings dict) as a (data, filter, colorspace, size) tuple"""
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    max_size = profile["max_size"]
+    if max_size and max(image.size) > max_size:
+        scale = max_size / max(image.size)
+        new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(new_size, Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    image.save(buf, "JPEG", quality=profile["quality"], subsampling=profile["subsampling"],
+               optimize=profile.get("optimize", True))
+    colorspace = "/DeviceGray" if image.mode == "L" else "/DeviceRGB"
+    return buf.getvalue(), "/DCTDecode", colorspace, image.size
+
+
+class PdfWriter:
+    """Writes an image-per-page PDF one page at a time
+
+    Each page is encoded and written to disk as soon as add_page() is called, so only
+    one bitmap is ever held, whatever the length of the book. Pages may be added out
+    of order by passing their index; the page tree is written in index order on close().
+    The file is assembled under a temporary name and renamed into place when complete.
+    """
+
+    def __init__(self, path, profile=None, resolution=PDF_RESOLUTION, page_store=None):
+        self.path = Path(path)
+        self.profile = get_profile(profile)
+        self.resolution = resolution
+        # Optional folder keeping each encoded page, see rebuild_pdf
+        self.page_store = Path(page_store) if page_store else None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        self._file = open(self._tmp_path, "wb")
+        self._offsets = {}
+        # 1 = catalog, 2 = page tree; both are written last
+        self._next_obj = 3
+        self._pages = []
+        self._file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @property
+    def page_count(self):
+        return len(self._pages)
+
+    def _new_obj(self):
+        num = self._next_obj
+        self._next_obj += 1
+        return num
+
+    def _write_obj(self, num, body, stream=None):
+        self._offsets[num] = self._file.tell()
+        self._file.write(f"{num} 0 obj\n".encode("ascii"))
+        self._file.write(body.encode("ascii"))
+        if stream is not None:
+            self._file.write(b"\nstream\n")
+            self._file.write(stream)
+            self._file.write(b"\nendstream")
+        self._file.write(b"\nendobj\n")
+
+    def encode_image(self, image):
+        """Encode a page image for the profile as a (data, filter, colorspace, size) tuple"""
+        return encode_page(image, self.profile)
+
+    def add_page(self, image, index=None):
+        """Encode one image and append it to the file as a page"""
+        self.add_prepared_page(self.encode_image(image), image.size, index)
+
+    def add_prepared_page(self, encoded, page_size, index=None):
+        """Append a page that encode_page already encoded for this profile (e.g. in a render worker)
+
+        page_size is the size of the page image before encoding. The page is also
+        kept in the page store.
+        """
+        if index is None:
+            index = len(self._pages)
+        data, filter_name, colorspace, (width, height) = encoded
+        if self.page_store is not None:
+            store_encoded_page(self.page_store, index, data, filter_name, colorspace, width, height, page_size)
+        self.add_encoded_page(data, filter_name, colorspace, width, height, index, page_size)
+
+    def add_encoded_page(self, data, filter_name, colorspace, width, height, index=None, page_size=None):
+        """Append an already encoded page image
+
+        page_size is the (width, height) in pixels the page is laid out for at the
+        writer's resolution; it defaults to the embedded image size.
+        """
+        if index is None:
+            index = len(self._pages)
+        layout_w, layout_h = page_size or (width, height)
+        page_w = layout_w * 72.0 / self.resolution
+        page_h = layout_h * 72.0 / self.resolution
+
+        image_obj = self._new_obj()
+        self._write_obj(
+            image_obj,
+            f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+            f"/ColorSpace {colorspace} /BitsPerComponent 8 /Filter {filter_name} /Length {len(data)} >>",
+            data,
+        )
+
+        content = f"q {page_w:.4f} 0 0 {page_h:.4f} 0 0 cm /Im0 Do Q".encode("ascii")
+        content_obj = self._new_obj()
+        self._write_obj(content_obj, f"<< /Length {len(content)} >>", content)
+
+        page_obj = self._new_obj()
+        self._write_obj(
+            page_obj,
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_w:.4f} {page_h:.4f}] "
+            f"/Resources << /XObject << /Im0 {image_obj} 0 R >> >> /Contents {content_obj} 0 R >>",
+        )
+        self._pages.append((index, page_obj))
+
+    def close(self):
+        """Write the page tree, cross-reference table and trailer, then move the file into place"""
+        if self._file.closed:
+            return None
+        kids = " ".join(f"{num} 0 R" for _, num in sorted(self._pages))
+        self._write_obj(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self._pages)} >>")
+        self._write_obj(1, "<< /Type /Catalog /Pages 2 0 R >>")
+
+        xref_offset = self._file.tell()
+        size = self._next_obj
+        lines = [f"xref\n0 {size}\n", "0000000000 65535 f \n"]
+        for num in range(1, size):
+            lines.append(f"{self._offsets[num]:010d} 00000 n \n")
+        lines.append(f"trailer\n<< /Size {size} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n")
+        self._file.write("".join(lines).encode("ascii"))
+        metrics.BYTES.inc(self._file.tell(), kind="pdf")
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        """Throw away a partially written file"""
+        if not self._file.closed:
+            self._file.close()
+        try:
+            self._tmp_path.unlink()
+        except OSError:
+            pass
+
+
+def store_encoded_page(page_store, index, data, filter_name, colorspace, width, height, page_size):
+    """Keep an encoded page (image stream plus its layout) so the PDF can be rebuilt without re-encoding"""
+    page_store = Path(page_store)
+    meta = {
+        "filter": filter_name,
+        "colorspace": colorspace,
+        "width": width,
+        "height": height,
+        "page_size": list(page_size),
+    }
+    fileutil.atomic_write_bytes(page_store / f"page_{index}.bin", data)
+    fileutil.atomic_write_json(page_store / f"page_{index}.json", meta)
+
+def load_encoded_pages(page_store):
+    """Stored pages as (index, data, meta), in page order"""
+    pages = []
+    for meta_path in Path(page_store).glob("page_*.json"):
+        meta = fileutil.read_json(meta_path)
+        data_path = meta_path.with_suffix(".bin")
+        if not meta or not data_path.exists():
+            continue
+        pages.append((int(meta_path.stem.split("_")[1]), data_path.read_bytes(), meta))
+    pages.sort(key=lambda p: p[0])
+    return pages
+
+@metrics.timed("pdf")
+def rebuild_pdf(output_pdfName, page_store, profile=None, replace=None):
+    """Reassemble a PDF from its stored pages, re-encoding only the pages in replace ({index: image})"""
+    replace = replace or {}
+    with PdfWriter(output_pdfName, profile, page_store=page_store) as writer:
+        stored = {index: (data, meta) for index, data, meta in load_encoded_pages(page_store)}
+        for index in sorted(set(stored) | set(replace)):
+            if index in replace:
+                writer.add_page(replace[index], index)
+            else:
+                data, meta = stored[index]
+                writer.add_encoded_page(data, meta["filter"], meta["colorspace"], meta["width"], meta["height"],
+                                        index, tuple(meta["page_size"]))
+    return Path(output_pdfName)
+
+def page_sort_key(name):
+    """Sort page_2 before page_10"""
+    stem = Path(name).stem
+    try:
+        return (0, int(stem.split("_")[-1]), stem)
+    except ValueError:
+        return (1, 0, stem)
+
+@metrics.timed("pdf")
+def img_to_pdf(images_folder, output_pdfName, profile=None):
     # Ensure paths are Path objects
     images_folder = Path(images_folder)
     output_pdfName = Path(output_pdfName)
     
     if not images_folder.exists():
         print(f"Error: Images folder not found at {images_folder}")
-        return
+        return None
 
     # Filter for standard image extensions
     valid_extensions = {".png", ".jpg", ".jpeg", ".bmp"}
-    file_list = sorted([f for f in os.listdir(images_folder) if Path(f).suffix.lower() in valid_extensions])
+    file_list = sorted([f for f in os.listdir(images_folder) if Path(f).suffix.lower() in valid_extensions], key=page_sort_key)
     
     if not file_list : 
         print("Folder is empty or contains no images!")
-        return
-        
-    img_list = []   
-    for f in file_list :  
-        img_path = images_folder / f
-        try:
-            image = Image.open(img_path).convert("RGB")
-            img_list.append(image)
-        except Exception as e:
-            print(f"Warning: Failed to load image {f}: {e}")
-
-    if not img_list :
-        print("Error: No valid images could be loaded.")
-        return 
-        
-    first_img = img_list[0]
-    remaining_img = img_list[1:] 
-
-    # Ensure output directory exists for the PDF
-    output_pdfName.parent.mkdir(parents=True, exist_ok=True)
-    
+        return None
+
     try:
-        first_img.save(output_pdfName, "PDF", resolution=100.0, save_all=True, append_images=remaining_img)
-        print(f"PDF successfully created at: {output_pdfName}")
-    except Exception as e:
+        settings = get_profile(profile)
+    except ValueError as e:
         print(f"Error saving PDF: {e}")
+        return None
 
-def archive_images():
-    """Move images to archive folder."""
-    current_folder = BASE_DIR / "static" / "images"
-    destination_folder = BASE_DIR / "output" / "prev_img_dataset"
-    
-    if not current_folder.exists():
-         return
-
-    destination_folder.mkdir(parents=True, exist_ok=True)
+    # Pages are decoded and encoded in the render pool, several at once, and written in page order
+    futures = [(f, render_pool.submit(encode_file, images_folder / f, settings)) for f in file_list]
 
-    files = os.listdir(current_folder)
-    print(f"Moving images to {destination_folder}...")
-    for f in files :
-        src = current_folder / f
-        dst = destination_folder / f
-        if src.is_file():
+    def load_pages():
+        for f, future in futures:
             try:
-                shutil.move(str(src), str(dst))
+                yield future.result()
             except Exception as e:
-                print(f"Warning: Failed to move {f}: {e}")
-    
-    print(f"Moved images to {destination_folder}")
+                print(f"Warning: Failed to load image {f}: {e}")
+
+    return images_to_pdf(load_pages(), output_pdfName, profile)
+
+def encode_file(path, profile):
+    """encode_page for an image file. Returns (encoded page, page size); picklable for render_pool."""
+    with Image.open(path) as image:
+        image.load()
+        return encode_page(image, profile), image.size
+
+@metrics.timed("pdf")
+def images_to_pdf(images, output_pdfName, profile=None):
+    """Write PIL images (any iterable, in page order) to one PDF, one page at a time
+
+    Items may also be (encoded page, page size) tuples from encode_file.
+    """
+    output_pdfName = Path(output_pdfName)
 
-def main():
-    img_folder = BASE_DIR / "static" / "images"
-    pdf_file = BASE_DIR / "static" / "pdf" / "storybook.pdf"
+    try:
+        with PdfWriter(output_pdfName, profile) as writer:
+            for image in images:
+                if isinstance(image, tuple):
+                    writer.add_prepared_page(*image)
+                elif image is not None:
+                    writer.add_page(image)
+            if not writer.page_count:
+                writer.abort()
+                print("Error: No valid images could be loaded.")
+                return None
+    except Exception as e:
+        print(f"Error saving PDF: {e}")
+        return None
+
+    print(f"PDF successfully created at: {output_pdfName}")
+    return output_pdfName
+
+def main(job_id=None, images=None, profile=None, archive_images=True):
+    """Build the storybook PDF from the images folder, or from in-memory images if given"""
+    img_folder = workspace.get_images_dir(job_id)
+    pdf_file = workspace.get_pdf_path(job_id)
     
     print("Starting PDF generation...")
-    img_to_pdf(img_folder, pdf_file) 
+    if images is not None:
+        images_to_pdf(images, pdf_file, profile)
+    else:
+        img_to_pdf(img_folder, pdf_file, profile) 
     
-    print("Archiving images...")
-    archive_images()
+    # Job workspaces keep their own images; only the shared folder is archived
+    if job_id is None and archive_images:
+        print("Archiving images...")
+        archive.archive_files(images_dir=img_folder, pdf_path=pdf_file)
+
+    return pdf_file
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+
+import archive
+import fileutil
+import workspace
+
+# Start illustrations while the story is still streaming in
+STREAM_STORY = os.getenv("STREAM_STORY", "1") != "0"
+# Pages a book may lose (to API errors or BOOK_DEADLINE) and still count as done; more fails the job
+MAX_MISSING_PAGES = int(os.getenv("MAX_MISSING_PAGES", "2"))
+
+
+class PipelineError(Exception):
+    """Raised when a storybook cannot be produced"""
+
+
+class StoryError(PipelineError):
+    """The story could not be generated or has no usable pages"""
+
+
+class ImageError(PipelineError):
+    """Too few page images could be generated"""
+
+
+def page_writer(writer, update, preview=None):
+    """on_page callback that appends each finished page to the PDF and reports progress
+
+    Pages come as images, image paths or finish_page dicts already encoded for the
+    writer's profile. If given, preview(image, key) is called for each image or path
+    before it is reported done (finish_page saves its own previews).
+    """
+    from PIL import Image
+
+    def add(key, image):
+        writer.add_page(image, int(key.split("_")[1]))
+        if preview:
+            try:
+                preview(image, key)
+            except Exception as e:
+                print(f"Warning: Failed to save preview for {key}: {e}")
+
+    def on_page(key, result):
+        if result:
+            if isinstance(result, dict):
+                writer.add_prepared_page(result["pdf"], result["size"], int(key.split("_")[1]))
+            elif isinstance(result, Image.Image):
+                add(key, result)
+            else:
+                with Image.open(result) as image:
+                    add(key, image)
+        update(page=(key, "done" if result else "failed"))
+
+    return on_page
+
+def save_render_settings(job_id, engine_id, profile):
+    """Remember how a job was rendered, for later page edits"""
+    fileutil.atomic_write_json(workspace.get_render_settings_path(job_id), {"engine_id": engine_id, "profile": profile})
+
+
+class StorybookPipeline:
+    """Story -> pages -> images -> PDF for one storybook at a time, in this process
+
+    Build it once per process and reuse it: it loads the API client modules and
+    fonts up front and picks the image engine once. run() keeps page images in
+    memory from the API response to the PDF (see IN_MEMORY_PIPELINE) and raises
+    PipelineError subclasses instead of exiting.
+    """
+
+    def __init__(self, engine_id=None, stream=None, image_workers=None):
+        # Imported here so the web process only loads the API clients once a pipeline is built
+        import gist_to_story
+        import image_generator
+        import pdf_generator
+        import split_pages
+
+        self.stories = gist_to_story
+        self.images = image_generator
+        self.pdf = pdf_generator
+        self.pages = split_pages
+        self.stream = STREAM_STORY if stream is None else stream
+        self.image_workers = image_workers
+        self._engine_id = engine_id
+        self._engine_lock = threading.Lock()
+        image_generator.load_fonts()
+
+    @property
+    def engine_id(self):
+        """Image engine, looked up on first use and then kept for the life of the pipeline"""
+        with self._engine_lock:
+            if self._engine_id is None:
+                self._engine_id = self.images.get_engine_id()
+            return self._engine_id
+
+    def open_pdf_writer(self, job_id, profile):
+        """PdfWriter for a job's storybook that also keeps each encoded page for later edits"""
+        return self.pdf.PdfWriter(workspace.get_pdf_path(job_id), profile,
+                                  page_store=workspace.get_pdf_pages_dir(job_id))
+
+    def run(self, gist, job_id=None, fresh=False, profile=None, stream=None, update=None):
+        """Produce one storybook in a job workspace and return a summary dict
+
+        update(**fields) receives progress (stage, pages_total, page=(key, state)).
+        """
+        if stream is None:
+            stream = self.stream
+        if update is None:
+            update = lambda **fields: None
+        job_id = workspace.create_workspace(job_id)
+        self.images.setup_environment(job_id)
+        timings = {}
+        started = time.time()
+
+        engine_id = self.engine_id
+        save_render_settings(job_id, engine_id, profile)
+
+        in_memory = self.images.IN_MEMORY_PIPELINE
+        out_dir = workspace.get_images_dir(job_id)
+        if in_memory and not self.images.SAVE_PAGE_IMAGES:
+            out_dir = None
+
+        update(stage="story")
+        # The book's latency budget runs from the start, so a slow story leaves less time for images
+        with self.images.StreamingPageRenderer(engine_id, out_dir, workers=self.image_workers, in_memory=in_memory,
+                                               deadline=self.images.book_deadline(started),
+                                               base_dir=workspace.get_bases_dir(job_id)) as renderer:
+            if stream:
+                # Illustrations start as soon as each page is parsed
+                def on_title(story):
+                    renderer.submit("page_1", self.pages.title_page_entry(story))
+
+                def on_story_page(number, page, story):
+                    renderer.submit(f"page_{number + 1}", self.pages.story_page_entry(story, page))
+
+                story_data = self.stories.stream_story_with_moral(gist, fresh=fresh, on_title=on_title,
+                                                                  on_page=on_story_page)
+            else:
+                story_data = self.stories.generate_story_with_moral(gist, fresh=fresh)
+            if not story_data["pages"]:
+                raise StoryError("The story came back without any pages")
+            timings["story"] = time.time() - started
+
+            t = time.time()
+            update(stage="pages")
+            output = self.pages.split_pages(story_data, job_id=job_id)
+            timings["pages"] = time.time() - t
+
+            # Pages go into the PDF as they finish, so no more than one bitmap per worker is held
+            t = time.time()
+            update(stage="images", pages_total=output["total_pages"], pages_done=0, pages={})
+            previews_dir = workspace.get_previews_dir(job_id)
+            preview = lambda image, key: self.images.save_preview(image, previews_dir, key)
+            with self.open_pdf_writer(job_id, profile) as writer:
+                # In memory, the overlay, page encoding and preview of each page run in the render pool
+                prepare = {"pdf_profile": writer.profile, "preview_dir": previews_dir} if in_memory else None
+                results = renderer.finish(self.pages.build_pages(story_data),
+                                          on_page=page_writer(writer, update, preview), keep_images=False,
+                                          prepare=prepare)
+                if not any(results.values()):
+                    raise ImageError("No images were generated")
+                pages_failed = [key for key, ok in results.items() if not ok]
+                if len(pages_failed) > MAX_MISSING_PAGES:
+                    raise ImageError(f"{len(pages_failed)} of {len(results)} pictures could not be drawn")
+                timings["images"] = time.time() - t
+                update(stage="pdf")
+                t = time.time()
+            timings["pdf"] = time.time() - t
+
+        # Index the finished book so it can be found again after the job folder is gone
+        archive.archive_job(job_id, gist)
+
+        return {
+            "job_id": job_id,
+            "title": story_data["title"],
+            "pages_total": output["total_pages"],
+            "pages_failed": pages_failed,
+            "pdf_path": workspace.get_pdf_path(job_id),
+            "engine_id": engine_id,
+            "profile": profile,
+            "timings": {stage: round(seconds, 3) for stage, seconds in timings.items()},
+            "seconds": round(time.time() - started, 3),
+        }
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+def get_pipeline():
+    """The process-wide pipeline, built on first use"""
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = StorybookPipeline()
+        return _pipeline
@@ -0,0 +1,85 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+from filelock import FileLock
+
+import fileutil
+import metrics
+
+BASE_DIR = Path(__file__).resolve().parent
+# Bucket state shared by every process on this host
+RATE_LIMIT_DIR = Path(os.getenv("RATE_LIMIT_DIR", BASE_DIR / "output" / "ratelimit"))
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT", "1") != "0"
+# Seconds of quota that may be spent in one burst after an idle period
+RATE_LIMIT_BURST_SECONDS = float(os.getenv("RATE_LIMIT_BURST_SECONDS", "1"))
+
+# Budgets per minute (0 = unlimited)
+BUDGETS = {
+    "openai": float(os.getenv("OPENAI_RPM", "500")),
+    "stability": float(os.getenv("STABILITY_RPM", "900")),
+    "stability_images": float(os.getenv("STABILITY_IMAGES_PER_MINUTE", "0")),
+}
+
+
+class TokenBucket:
+    """Token bucket whose state lives in a file, so all processes on the host share it
+
+    acquire() reserves its tokens right away, going into debt if the bucket is
+    empty, and then sleeps until the debt would have been refilled. Callers are
+    therefore spaced out evenly at the refill rate instead of all retrying when
+    tokens come back, which keeps throughput at the quota without overshooting it.
+    """
+
+    def __init__(self, name, per_minute, burst=None, state_dir=None):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.capacity = burst if burst is not None else max(1.0, self.rate * RATE_LIMIT_BURST_SECONDS)
+        state_dir = Path(state_dir or RATE_LIMIT_DIR)
+        self.path = state_dir / f"{name}.json"
+        state_dir.mkdir(parents=True, exist_ok=True)
+        self._file_lock = FileLock(str(state_dir / f"{name}.lock"))
+        self._thread_lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Take tokens from the bucket now and return the seconds to wait before using them"""
+        with self._thread_lock, self._file_lock:
+            now = time.time()
+            state = fileutil.read_json(self.path) or {}
+            available = state.get("tokens", self.capacity)
+            elapsed = max(0.0, now - state.get("updated", now))
+            available = min(self.capacity, available + elapsed * self.rate) - tokens
+            fileutil.atomic_write_json(self.path, {"tokens": available, "updated": now})
+        return max(0.0, -available / self.rate)
+
+    def acquire(self, tokens=1):
+        """Block until tokens may be spent. Returns the seconds waited."""
+        if self.rate <= 0:
+            return 0.0
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def get_bucket(name):
+    """Shared bucket for one of the BUDGETS"""
+    with _buckets_lock:
+        if name not in _buckets:
+            _buckets[name] = TokenBucket(name, BUDGETS[name])
+        return _buckets[name]
+
+def acquire(name, tokens=1):
+    """Wait for room in a budget before calling the provider. Returns the seconds waited."""
+    if not RATE_LIMIT_ENABLED or BUDGETS.get(name, 0) <= 0:
+        return 0.0
+    waited = get_bucket(name).acquire(tokens)
+    if waited:
+        metrics.RATE_LIMIT_WAIT.inc(waited, budget=name)
+    if waited >= 1:
+        print(f"Rate limit {name}: waited {waited:.1f}s")
+    return waited
@@ -0,0 +1,85 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+
+# Web server processes on this machine (e.g. gunicorn -w). Each one starts its own render
+# pool, so the default below splits the cores between them instead of giving each all of them.
+WEB_WORKERS = max(1, int(os.getenv("WEB_WORKERS", "1")))
+# Worker processes for the CPU-bound page work (text overlay, page image and PDF encoding),
+# so books rendering at the same time use every core instead of sharing one GIL.
+# 0 runs that work in the calling thread.
+RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES", str(max(1, (os.cpu_count() or 1) // WEB_WORKERS))))
+# "spawn" keeps workers clear of locks held by the web process's other threads at fork time
+RENDER_START_METHOD = os.getenv("RENDER_START_METHOD", "spawn")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """The process-wide render pool, started on first use (None when RENDER_PROCESSES is 0)"""
+    global _pool
+    if RENDER_PROCESSES <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=RENDER_PROCESSES,
+                                        mp_context=multiprocessing.get_context(RENDER_START_METHOD))
+        return _pool
+
+def _discard_pool(pool):
+    """Forget a pool whose worker died so the next task starts a fresh one"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _run(fn, args, kwargs):
+    """Worker side: run fn and send its stage timings back along with the result"""
+    observations = []
+    listener = lambda name, labels, value: observations.append((name, labels, value))
+    metrics.add_listener(listener)
+    try:
+        return fn(*args, **kwargs), observations
+    finally:
+        metrics.remove_listener(listener)
+
+def submit(fn, *args, **kwargs):
+    """Run fn(*args, **kwargs) in the render pool and return a Future of its result
+
+    fn, its arguments and its result must be picklable. Stage timings recorded by
+    fn in the worker show up in this process's metrics. Without a pool fn runs
+    right away and the returned Future is already done.
+    """
+    future = Future()
+    pool = get_pool()
+    if pool is None:
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def done(inner):
+        try:
+            result, observations = inner.result()
+        except BrokenProcessPool as e:
+            _discard_pool(pool)
+            future.set_exception(e)
+            return
+        except Exception as e:
+            future.set_exception(e)
+            return
+        metrics.replay(observations)
+        future.set_result(result)
+
+    try:
+        pool.submit(_run, fn, args, kwargs).add_done_callback(done)
+    except BrokenProcessPool as e:
+        _discard_pool(pool)
+        future.set_exception(e)
+    return future
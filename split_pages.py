@@ -3,45 +3,44 @@ import json
 import uuid
 from pathlib import Path
 
-def split_pages(story_data, base_dir=None):
-    """Split story into separate JSON files in the stories folder"""
-    
-    # Default to stories folder in project root (not static/stories)
-    if base_dir is None:
-        base_dir = Path(__file__).resolve().parent / "stories"
-    else:
-        base_dir = Path(base_dir)
-    
-    # Create stories directory if it doesn't exist
-    base_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Remove leftover story files to avoid mixing pages from previous stories
-    for old in list(base_dir.glob('page_*.json')) + [base_dir / 'story.json', base_dir / 'metadata.json', base_dir / 'story_structured.json']:
-        try:
-            if old.exists() and old.is_file():
-                old.unlink()
-        except Exception:
-            pass
+import fileutil
+import metrics
+import workspace
 
-    # Main JSON file that contains all pages with page numbers as keys
-    main_json = {}
-    
-    # Page 1: Title Page
-    main_json["page_1"] = {
+# "compact": one minified story.json with a character table; "legacy": pretty-printed page dict
+STORY_FORMAT = os.getenv("STORY_FORMAT", "compact")
+# Also write page_N.json files for the compact format
+WRITE_PAGE_FILES = os.getenv("WRITE_PAGE_FILES", "0") != "0"
+COMPACT_FORMAT = "compact-v1"
+
+def title_page_entry(story_data):
+    """Page 1: Title Page"""
+    return {
         "type": "title",
         "title": story_data["title"],
         "story_overview": story_data["story_overview"],
         "character": story_data["character"]
     }
+
+def story_page_entry(story_data, page):
+    """One of the story pages (2 to N), without the moral"""
+    return {
+        "type": "story",
+        "text": page["text"],
+        "scene": page["scene"],
+        "character": story_data["character"]
+    }
+
+def build_pages(story_data):
+    """All page entries keyed page_1..page_N, as saved in story.json"""
+    main_json = {}
+    
+    # Page 1: Title Page
+    main_json["page_1"] = title_page_entry(story_data)
     
     # Story Pages (2 to N)
     for i, page in enumerate(story_data["pages"], start=2):
-        page_data = {
-            "type": "story",
-            "text": page["text"],
-            "scene": page["scene"],
-            "character": story_data["character"]
-        }
+        page_data = story_page_entry(story_data, page)
         
         # Add moral to the last page
         if i == len(story_data["pages"]) + 1:
@@ -49,26 +48,121 @@ def split_pages(story_data, base_dir=None):
         
         main_json[f"page_{i}"] = page_data
     
-    # Save all pages in one JSON file
-    with open(base_dir / "story.json", "w", encoding="utf-8") as f:
-        json.dump(main_json, f, indent=4, ensure_ascii=False)
-    
-    # Also create individual page files 
-    for page_key, page_data in main_json.items():
-        page_num = page_key.split("_")[1]
-        with open(base_dir / f"page_{page_num}.json", "w", encoding="utf-8") as f:
-            json.dump({page_key: page_data}, f, indent=4, ensure_ascii=False)
-    
-    # Create metadata file
-    metadata = {
+    return main_json
+
+def compact_story(story_data):
+    """Single-document story: characters stored once and referenced by ID from each page"""
+    characters = {}
+    character_id = None
+    if story_data.get("character"):
+        character_id = "c1"
+        characters[character_id] = story_data["character"]
+
+    pages = []
+    for page_data in build_pages(story_data).values():
+        page = {k: v for k, v in page_data.items() if k != "character"}
+        page["character"] = character_id
+        pages.append(page)
+
+    return {
+        "format": COMPACT_FORMAT,
         "title": story_data["title"],
-        "total_pages": len(main_json),
-        "pages": list(main_json.keys()),
-        "main_file": "story.json"
+        "characters": characters,
+        "pages": pages
     }
+
+def expand_story(story_json):
+    """Page entries keyed page_1..page_N from either the compact or the legacy story.json"""
+    if story_json.get("format") != COMPACT_FORMAT:
+        return {k: v for k, v in story_json.items() if k.startswith("page_")}
+
+    characters = story_json.get("characters", {})
+    pages = {}
+    for i, page in enumerate(story_json.get("pages", []), start=1):
+        page = dict(page)
+        page["character"] = characters.get(page.get("character"), {})
+        pages[f"page_{i}"] = page
+    return pages
+
+def story_from_pages(pages):
+    """Rebuild the story dict generate_story_with_moral returns from page entries"""
+    keys = sorted((k for k in pages if k.startswith("page_")), key=lambda x: int(x.split("_")[1]))
+    title_page = pages[keys[0]] if keys else {}
+    story_pages = [pages[k] for k in keys[1:]]
+    return {
+        "title": title_page.get("title", ""),
+        "story_overview": title_page.get("story_overview", ""),
+        "character": title_page.get("character", {}),
+        "pages": [{"text": p.get("text", ""), "scene": p.get("scene", "")} for p in story_pages],
+        "moral": story_pages[-1].get("moral", "") if story_pages else ""
+    }
+
+def load_story(path):
+    """Read a story.json written in either format, returning its page entries"""
+    with open(path, "r", encoding="utf-8") as f:
+        return expand_story(json.load(f))
+
+@metrics.timed("split_pages")
+def split_pages(story_data, base_dir=None, job_id=None, story_format=None, page_files=None):
+    """Split story into separate JSON files in the stories folder (or the job's own folder)
+
+    story_format "compact" writes one minified story.json (atomically); "legacy" writes the
+    pretty-printed page dict plus metadata.json. Per-page files are written if page_files
+    is True (the default for the legacy format only).
+    """
+    if story_format is None:
+        story_format = STORY_FORMAT
+    if page_files is None:
+        page_files = story_format == "legacy" or WRITE_PAGE_FILES
+    
+    # Default to stories folder in project root (not static/stories)
+    if base_dir is None:
+        base_dir = workspace.get_stories_dir(job_id)
+    else:
+        base_dir = Path(base_dir)
+    
+    # Create stories directory if it doesn't exist
+    base_dir.mkdir(parents=True, exist_ok=True)
     
-    with open(base_dir / "metadata.json", "w", encoding="utf-8") as f:
-        json.dump(metadata, f, indent=4, ensure_ascii=False)
+    # Main JSON file that contains all pages with page numbers as keys
+    main_json = build_pages(story_data)
+    
+    # Optional individual page files, written before story.json so a story.json on
+    # disk always means the whole story is there
+    if page_files:
+        for page_key, page_data in main_json.items():
+            page_num = page_key.split("_")[1]
+            fileutil.atomic_write_json(base_dir / f"page_{page_num}.json", {page_key: page_data}, indent=4)
+    
+    if story_format == "compact":
+        fileutil.atomic_write_json(base_dir / "story.json", compact_story(story_data), separators=(",", ":"))
+    else:
+        # Create metadata file
+        metadata = {
+            "title": story_data["title"],
+            "total_pages": len(main_json),
+            "pages": list(main_json.keys()),
+            "main_file": "story.json"
+        }
+        fileutil.atomic_write_json(base_dir / "metadata.json", metadata, indent=4)
+
+        # Save all pages in one JSON file
+        fileutil.atomic_write_json(base_dir / "story.json", main_json, indent=4)
+
+    # Only now remove files left from a previous story, so story.json is never missing
+    written = {f"page_{key.split('_')[1]}.json" for key in main_json} if page_files else set()
+    stale = [p for p in base_dir.glob('page_*.json') if p.name not in written]
+    stale.append(base_dir / 'story_structured.json')
+    if story_format == "compact":
+        stale.append(base_dir / 'metadata.json')
+    for old in stale:
+        try:
+            if old.is_file():
+                old.unlink()
+        except OSError:
+            pass
+
+    metrics.BYTES.inc((base_dir / "story.json").stat().st_size, kind="story")
     
     return {
         "output_dir": str(base_dir),
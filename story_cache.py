@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+import fileutil
+import metrics
+
+BASE_DIR = Path(__file__).resolve().parent
+CACHE_DIR = Path(os.getenv("STORY_CACHE_DIR", BASE_DIR / "output" / "story_cache"))
+# Entries older than this are regenerated
+CACHE_TTL = int(os.getenv("STORY_CACHE_TTL", str(7 * 24 * 3600)))
+# Oldest entries are dropped beyond this many stories
+CACHE_MAX_ENTRIES = int(os.getenv("STORY_CACHE_MAX_ENTRIES", "500"))
+CACHE_ENABLED = os.getenv("STORY_CACHE", "1") != "0"
+
+_evict_lock = threading.Lock()
+
+def normalize_gist(gist):
+    """Case- and whitespace-insensitive form of a gist"""
+    return re.sub(r"\s+", " ", gist).strip().lower()
+
+def cache_key(gist, max_chars, model, temperature, prompt_version):
+    """Hash of everything that shapes the completion"""
+    params = {
+        "gist": normalize_gist(gist),
+        "max_chars": max_chars,
+        "model": model,
+        "temperature": temperature,
+        "prompt_version": prompt_version,
+    }
+    raw = json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+def get_cache_path(key):
+    return CACHE_DIR / f"{key}.json"
+
+def load(key):
+    """Return the cached entry {"raw", "story", "created"} for key, or None"""
+    if not CACHE_ENABLED:
+        return None
+    path = get_cache_path(key)
+    entry = fileutil.read_json(path)
+    if not entry or "story" not in entry:
+        metrics.CACHE_REQUESTS.inc(cache="story", result="miss")
+        return None
+    if time.time() - entry.get("created", 0) > CACHE_TTL:
+        try:
+            path.unlink()
+        except OSError:
+            pass
+        metrics.CACHE_REQUESTS.inc(cache="story", result="expired")
+        return None
+    metrics.CACHE_REQUESTS.inc(cache="story", result="hit")
+    return entry
+
+def store(key, raw, story):
+    """Save a raw completion and its parsed story under key"""
+    if not CACHE_ENABLED:
+        return
+    entry = {"created": time.time(), "raw": raw, "story": story}
+    try:
+        fileutil.atomic_write_json(get_cache_path(key), entry)
+    except OSError as e:
+        print(f"Warning: Failed to cache story: {e}")
+        return
+    evict()
+
+def evict(max_entries=None):
+    """Drop expired entries, then the oldest ones beyond max_entries"""
+    if max_entries is None:
+        max_entries = CACHE_MAX_ENTRIES
+    if not CACHE_DIR.exists():
+        return 0
+
+    with _evict_lock:
+        now = time.time()
+        entries = []
+        removed = 0
+        for path in CACHE_DIR.glob("*.json"):
+            try:
+                mtime = path.stat().st_mtime
+            except OSError:
+                continue
+            if now - mtime > CACHE_TTL:
+                try:
+                    path.unlink()
+                    removed += 1
+                except OSError:
+                    pass
+                continue
+            entries.append((mtime, path))
+
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - max_entries)]:
+            try:
+                path.unlink()
+                removed += 1
+            except OSError:
+                pass
+        return removed
@@ -14,7 +14,7 @@ def main():
     
     print(f"Story generated: '{result['title']}'")
     print(f" {len(result['pages'])} pages created")
-    print(f" Main character: {result['character']['name']}")
+    print(f" Main character: {result['character'].get('name', 'unknown')}")
     
     # Split and save pages
     print("\n Saving pages to JSON files...")
@@ -0,0 +1,84 @@
+import os
+import re
+import shutil
+import uuid
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+JOBS_DIR = Path(os.getenv("JOBS_DIR", BASE_DIR / "output" / "jobs"))
+BATCHES_DIR = Path(os.getenv("BATCHES_DIR", BASE_DIR / "output" / "batches"))
+
+# Legacy shared locations, used when no job ID is given
+SHARED_STORIES_DIR = BASE_DIR / "stories"
+SHARED_IMAGES_DIR = BASE_DIR / "static" / "images"
+SHARED_PDF_PATH = BASE_DIR / "static" / "pdf" / "storybook.pdf"
+
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{12}$")
+
+def new_job_id():
+    """Create a new random job ID"""
+    return uuid.uuid4().hex[:12]
+
+def is_valid_job_id(job_id):
+    """Job IDs end up in file paths, so only accept the format we generate"""
+    return bool(job_id) and bool(JOB_ID_PATTERN.match(str(job_id)))
+
+def get_job_dir(job_id):
+    """Root working directory of a job"""
+    if not is_valid_job_id(job_id):
+        raise ValueError(f"Invalid job ID: {job_id!r}")
+    return JOBS_DIR / job_id
+
+def get_stories_dir(job_id=None):
+    """Folder holding story.json and page files for a job"""
+    if job_id is None:
+        return SHARED_STORIES_DIR
+    return get_job_dir(job_id) / "story"
+
+def get_images_dir(job_id=None):
+    """Folder holding the generated page images for a job"""
+    if job_id is None:
+        return SHARED_IMAGES_DIR
+    return get_job_dir(job_id) / "images"
+
+def get_pdf_path(job_id=None):
+    """Final storybook PDF for a job"""
+    if job_id is None:
+        return SHARED_PDF_PATH
+    return get_job_dir(job_id) / "storybook.pdf"
+
+def create_workspace(job_id=None):
+    """Create the working folders for a job and return its ID"""
+    if job_id is None:
+        job_id = new_job_id()
+    for folder in (get_stories_dir(job_id), get_images_dir(job_id), get_pdf_path(job_id).parent):
+        folder.mkdir(parents=True, exist_ok=True)
+    return job_id
+
+def remove_workspace(job_id):
+    """Delete a job's working folder and everything in it"""
+    shutil.rmtree(get_job_dir(job_id), ignore_errors=True)
+
+def get_status_path(job_id):
+    """Progress file of a job, readable from any worker process"""
+    return get_job_dir(job_id) / "status.json"
+
+def get_pdf_pages_dir(job_id):
+    """Encoded PDF page images of a job, kept so single pages can be swapped later"""
+    return get_job_dir(job_id) / "pdf_pages"
+
+def get_bases_dir(job_id):
+    """Clean (text-free) page illustrations of a job, so text edits never redraw a picture"""
+    return get_job_dir(job_id) / "bases"
+
+def get_previews_dir(job_id):
+    """Page thumbnails shown while a job renders"""
+    return get_job_dir(job_id) / "previews"
+
+def get_render_settings_path(job_id):
+    """Engine and PDF profile a job was rendered with"""
+    return get_job_dir(job_id) / "render.json"
+
+def get_batch_dir(name):
+    """Checkpoints and report of a batch run"""
+    return BATCHES_DIR / name